@@ -7,17 +7,24 @@ def load_config(config_filepath):
     toolkit.load_config(config_filepath)
 
 
-def get_resources(state='active', publisher_ref=None, resource_id=None, dataset_name=None):
-    ''' Returns all active resources, or filtered by the given criteria. '''
+def get_resources(state='active', publisher_ref=None, resource_id=None,
+                  dataset_name=None, columns=None, chunk_size=1000):
+    ''' Returns all active resources, or filtered by the given criteria, as
+    a ResourceStream - iterating over it streams them from the database
+    chunk_size at a time, and len() gives the count.
+
+    :param columns: select just these columns e.g. (model.Resource.id,) rather
+                    than whole Resource objects
+    '''
     from ckan import model
-    resources = model.Session.query(model.Resource) \
-        .filter_by(state=state)
+    resources = model.Session.query(*(columns or [model.Resource])) \
+        .filter(model.Resource.state == state)
     if hasattr(model, 'ResourceGroup'):
         # earlier CKANs had ResourceGroup
         resources = resources.join(model.ResourceGroup)
     resources = resources \
         .join(model.Package) \
-        .filter_by(state='active')
+        .filter(model.Package.state == 'active')
     criteria = [state]
     if publisher_ref:
         publisher = model.Group.get(publisher_ref)
@@ -30,6 +37,25 @@ def get_resources(state='active', publisher_ref=None, resource_id=None, dataset_
     if resource_id:
         resources = resources.filter(model.Resource.id == resource_id)
         criteria.append('Resource:%s' % resource_id)
-    resources = resources.all()
+    resources = ResourceStream(resources, chunk_size)
     print('%i resources (%s)' % (len(resources), ' '.join(criteria)))
     return resources
+
+
+class ResourceStream(object):
+    '''The results of a query, streamed with yield_per, so that only
+    chunk_size of them are in memory at a time. len() is a COUNT query (done
+    once).'''
+
+    def __init__(self, query, chunk_size=1000):
+        self.query = query
+        self.chunk_size = chunk_size
+        self._count = None
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self.query.order_by(None).count()
+        return self._count
+
+    def __iter__(self):
+        return iter(self.query.yield_per(self.chunk_size))
@@ -12,10 +12,7 @@ import json
 import datetime
 
 from . import common
-from .running_stats import StatsList
-
-# pip install 'ProgressBar==2.3'
-from progressbar import ProgressBar, Percentage, Bar, ETA
+from .running_stats import BoundedStatsList
 
 START_OF_TIME = datetime.datetime(1980, 1, 1)
 END_OF_TIME = datetime.datetime(9999, 12, 31)
@@ -26,29 +23,68 @@ TODAY = datetime.datetime.utcnow()
 
 def migrate(options):
     from ckan import model
-    from ckanext.archiver.model import Archival
-    from ckanext.qa.model import QA
+    from ckanext.qa import lib
+    # pip install 'ProgressBar==2.3'
+    from progressbar import ProgressBar, Percentage, Bar, ETA
 
     resources = common.get_resources(state='active',
                                      publisher_ref=options.publisher,
                                      resource_id=options.resource,
-                                     dataset_name=options.dataset)
-    stats = StatsList()
+                                     dataset_name=options.dataset,
+                                     columns=(model.Resource.id,
+                                              model.Resource.package_id),
+                                     chunk_size=options.chunk_size)
+    stats = BoundedStatsList()
     widgets = ['Resources: ', Percentage(), ' ', Bar(), ' ', ETA()]
     progress = ProgressBar(widgets=widgets)
-    for res in progress(resources):
+    for chunk in lib.chunks(progress(resources), options.chunk_size):
+        migrate_chunk(chunk, options, stats)
+
+    print('Summary\n', stats.report())
+    if options.write:
+        model.repo.commit_and_remove()
+        print('Written')
+        from ckanext.qa.model import QAPackage
+        print('Dataset QA aggregates rebuilt: %i' % QAPackage.rebuild())
+
+
+def migrate_chunk(resources, options, stats):
+    '''Migrates a chunk of resources, prefetching what it needs from
+    TaskStatus, Archival, ResourceRevision, QA and Package with a query each,
+    and inserting the new QA rows in one batch.'''
+    from ckan import model
+    from ckanext.archiver.model import Archival
+    from ckanext.qa.model import QA, make_uuid
+
+    resource_ids = [res.id for res in resources]
+    qa_task_statuses = {}
+    for task_status in model.Session.query(model.TaskStatus)\
+            .filter(model.TaskStatus.entity_id.in_(resource_ids))\
+            .filter_by(task_type='qa')\
+            .filter_by(key='status'):
+        qa_task_statuses.setdefault(task_status.entity_id, task_status)
+    archivals = dict(
+        (archival.resource_id, archival)
+        for archival in model.Session.query(Archival)
+        .filter(Archival.resource_id.in_(resource_ids)))
+    revision_timestamps = get_revision_timestamps(resource_ids)
+    qas = QA.get_for_resources(resource_ids)
+    package_names = dict(
+        model.Session.query(model.Package.id, model.Package.name)
+        .filter(model.Package.id.in_(
+            set(res.package_id for res in resources))))
+
+    new_qas = []
+    for res in resources:
+        package_name = package_names.get(res.package_id)
         # Gather the details of QA from TaskStatus
         # to fill all properties of QA apart from:
         # * package_id
         # * resource_id
         fields = {}
-        qa_task_status = model.Session.query(model.TaskStatus)\
-            .filter_by(entity_id=res.id)\
-            .filter_by(task_type='qa')\
-            .filter_by(key='status')\
-            .first()
+        qa_task_status = qa_task_statuses.get(res.id)
         if not qa_task_status:
-            add_stat('No QA data', res, stats)
+            add_stat('No QA data', res, stats, package_name=package_name)
             continue
         qa_error = json.loads(qa_task_status.error)
         fields['openness_score'] = int(qa_task_status.value)
@@ -57,9 +93,10 @@ def migrate(options):
         qa_date = qa_task_status.last_updated
         # NB qa_task_status.last_updated appears to be 1hr ahead of the revision
         # time, so some timezone nonesense going on. Can't do much.
-        archival = Archival.get_for_resource(res.id)
+        archival = archivals.get(res.id)
         if not archival:
-            print(add_stat('QA but no Archival data', res, stats))
+            print(add_stat('QA but no Archival data', res, stats,
+                           package_name=package_name))
             continue
         archival_date = archival.updated
         # the state of the resource was as it was archived on the date of
@@ -84,15 +121,18 @@ def migrate(options):
             fields['updated'] = qa_date
             fields['created'] = qa_date
             get_resource_as_at = qa_date
-        res_rev = model.Session.query(model.ResourceRevision).\
-            filter_by(id=res.id).\
-            filter(model.ResourceRevision.revision_timestamp < get_resource_as_at).\
-            order_by(model.ResourceRevision.revision_timestamp.desc()).\
-            first()
-        fields['resource_timestamp'] = res_rev.revision_timestamp
+        # the latest revision before then
+        earlier_timestamps = [
+            timestamp for timestamp in revision_timestamps.get(res.id, [])
+            if timestamp < get_resource_as_at]
+        if not earlier_timestamps:
+            add_stat('No resource revision before the QA', res, stats,
+                     package_name=package_name)
+            continue
+        fields['resource_timestamp'] = earlier_timestamps[-1]
 
         # Compare with any existing data in the Archival table
-        qa = QA.get_for_resource(res.id)
+        qa = qas.get(res.id)
         if qa:
             changed = None
             for field, value in fields.items():
@@ -101,30 +141,45 @@ def migrate(options):
                         setattr(qa, field, value)
                     changed = True
             if not changed:
-                add_stat('Already exists correctly in QA table', res, stats)
+                add_stat('Already exists correctly in QA table', res, stats,
+                         package_name=package_name)
                 continue
-            add_stat('Updated in QA table', res, stats)
+            add_stat('Updated in QA table', res, stats,
+                     package_name=package_name)
         else:
-            qa = QA.create(res.id)
-            if options.write:
-                for field, value in fields.items():
-                    setattr(qa, field, value)
-                model.Session.add(qa)
-            add_stat('Added to QA table', res, stats)
+            fields.update(id=make_uuid(), resource_id=res.id,
+                          package_id=res.package_id)
+            new_qas.append(fields)
+            add_stat('Added to QA table', res, stats,
+                     package_name=package_name)
 
-    print('Summary\n', stats.report())
     if options.write:
-        model.repo.commit_and_remove()
-        print('Written')
+        model.Session.bulk_insert_mappings(QA, new_qas)
+        model.Session.flush()
 
 
-def add_stat(outcome, res, stats, extra_info=None):
-    try:
-        # pre CKAN 2.3 model
-        package_name = res.resource_group.package.name
-    except AttributeError:
-        # CKAN 2.3+ model
-        package_name = res.package.name
+def get_revision_timestamps(resource_ids):
+    '''Returns the revision timestamps of each of the resources, oldest
+    first, as {resource_id: [timestamp, ...]}'''
+    from ckan import model
+    revision_timestamps = {}
+    for res_id, revision_timestamp in model.Session.query(
+            model.ResourceRevision.id,
+            model.ResourceRevision.revision_timestamp)\
+            .filter(model.ResourceRevision.id.in_(resource_ids))\
+            .order_by(model.ResourceRevision.revision_timestamp):
+        revision_timestamps.setdefault(res_id, []).append(revision_timestamp)
+    return revision_timestamps
+
+
+def add_stat(outcome, res, stats, extra_info=None, package_name=None):
+    if package_name is None:
+        try:
+            # pre CKAN 2.3 model
+            package_name = res.resource_group.package.name
+        except AttributeError:
+            # CKAN 2.3+ model
+            package_name = res.package.name
     res_id = '%s %s' % (package_name, res.id[:4])
     if extra_info:
         res_id += ' %s' % extra_info
@@ -150,6 +205,9 @@ if __name__ == '__main__':
     parser.add_option('-p', '--publisher', dest='publisher')
     parser.add_option('-d', '--dataset', dest='dataset')
     parser.add_option('-r', '--resource', dest='resource')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int',
+                      default=1000,
+                      help='number of resources to migrate at a time')
     (options, args) = parser.parse_args()
     if len(args) != 1:
         parser.error('Wrong number of arguments (%i)' % len(args))
@@ -30,11 +30,26 @@ print(package_stats.report())
 > deleted: 30 pollution-uk, flood-regions, river-quality, ...
 > not deleted: 70 spending-bristol, ...
 
+BoundedStatsList - like StatsList, but for a large number of objects. It
+keeps just a sample of the IDs, and reports the rate of each outcome and,
+for those timed, the latency percentiles
+
+from .running_stats import BoundedStatsList
+resource_stats = BoundedStatsList()
+for resource in resources:
+    with resource_stats.time(value=resource.id) as timer:
+        timer.category = score(resource)
+print(resource_stats.report())
+> scored: 90000 (250.0/s) p50=0.021s p95=0.110s p99=0.540s ['ab12', ...]
+> failed: 10000 (27.8/s) p50=1.500s p95=9.000s p99=30.00s ['cd34', ...]
+
 '''
 
 import copy
 import datetime
+import math
 import six
+import time
 
 
 class StatsCount(dict):
@@ -104,6 +119,102 @@ class StatsList(StatsCount):
         return (value_str, number_of_values)
 
 
+class BoundedStatsList(StatsCount):
+    # {category:count}, with the first sample_size values of each category,
+    # and a histogram of the latencies recorded for it
+    sample_size = 10
+    # latency histogram buckets: the first holds up to 1ms, and each is 19%
+    # (a quarter of a doubling) wider than the last
+    _bucket_min = 0.001
+    _bucket_factor = 2 ** 0.25
+
+    def __init__(self, *args, **kwargs):
+        super(BoundedStatsList, self).__init__(*args, **kwargs)
+        self._samples = {}
+        self._latencies = {}  # {category: {bucket: count}}
+
+    def add(self, category, value):
+        self.increment(category)
+        sample = self._samples.setdefault(category, [])
+        if len(sample) < self.sample_size:
+            sample.append(value)
+        return '%s: %s' % (category, value)  # so you can log it too
+
+    def record_latency(self, category, seconds):
+        if seconds <= self._bucket_min:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(math.log(seconds / self._bucket_min,
+                                            self._bucket_factor)))
+        histogram = self._latencies.setdefault(category, {})
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def time(self, category=None, value=None):
+        '''Returns a context manager that times a block, and then adds the
+        value and latency to the category. The category can be decided in
+        the block, by setting it on the timer. If the block raises an
+        exception without it set, the exception's class name is used.'''
+        return _Timer(self, category, value)
+
+    def percentile(self, category, percent):
+        '''Returns the latency that the given percentage of the timed values
+        of the category were within (to the resolution of the histogram), or
+        None if none were timed.'''
+        histogram = self._latencies.get(category)
+        if not histogram:
+            return None
+        target = sum(histogram.values()) * percent / 100.0
+        so_far = 0
+        for bucket in sorted(histogram):
+            so_far += histogram[bucket]
+            if so_far >= target:
+                break
+        return self._bucket_min * self._bucket_factor ** bucket
+
+    def rate(self, category):
+        '''Returns the number per second of the category since the start.'''
+        elapsed = datetime.datetime.utcnow() - self._start_time
+        seconds = elapsed.total_seconds()
+        return self[category] / seconds if seconds else 0.0
+
+    def report_value(self, category):
+        count = self[category]
+        value_str = '%i (%.1f/s)' % (count, self.rate(category))
+        if category in self._latencies:
+            value_str += ' ' + ' '.join(
+                'p%i=%.3fs' % (percent, self.percentile(category, percent))
+                for percent in (50, 95, 99))
+        sample = self._samples.get(category)
+        if sample:
+            value_str += ' %r' % sample
+            if count > len(sample):
+                value_str = value_str[:-1] + ', ...]'
+        if len(value_str) > self.report_value_limit:
+            value_str = value_str[:self.report_value_limit] + '...'
+        return (value_str, count)
+
+
+class _Timer(object):
+    def __init__(self, stats, category, value):
+        self.stats = stats
+        self.category = category
+        self.value = value
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        category = self.category or \
+            (exc_type.__name__ if exc_type else 'Unknown')
+        self.stats.record_latency(category, time.time() - self.start)
+        if self.value is None:
+            self.stats.increment(category)
+        else:
+            self.stats.add(category, self.value)
+        return False
+
+
 if __name__ == '__main__':
     package_stats = StatsList()
     package_stats.add('Success', 'good1')
@@ -20,11 +20,68 @@ def get_commands():
 
     @qa.command()
     @click.option('-q', '--queue')
+    @click.option('-f', '--force', is_flag=True,
+                  help='Rescore resources even if unchanged since last QA')
+    @click.option('-b', '--batch-size', type=click.IntRange(min=1), default=1,
+                  help='Number of datasets to QA in each queued job')
+    @click.option('--resume', metavar='RUN_ID',
+                  help='Queue the datasets of an interrupted run that are '
+                       'not done yet')
+    @click.option('--since', type=click.DateTime(),
+                  help='Only datasets with a resource created, modified or '
+                       'archived since this date/time (UTC)')
+    @click.option('--stale', is_flag=True,
+                  help='Only datasets with a resource modified or archived '
+                       'since its QA, or never QA\'d')
     @click.argument('args', nargs=-1)
-    def update(args, queue):
+    def update(args, queue, force, batch_size, resume, since, stale):
         """QA analysis on all resources in a given dataset, or on all
            datasets if no dataset given"""
-        commands.update(args, queue)
+        commands.update(args, queue, force=force, batch_size=batch_size,
+                        resume=resume, since=since, stale=stale)
+
+    @qa.command()
+    @click.option('-p', '--processes', type=int,
+                  help='Number of worker processes (default: one per CPU)')
+    @click.option('-f', '--force', is_flag=True,
+                  help='Rescore resources even if unchanged since last QA')
+    @click.option('--since', type=click.DateTime(),
+                  help='Only datasets with a resource created, modified or '
+                       'archived since this date/time (UTC)')
+    @click.option('--stale', is_flag=True,
+                  help='Only datasets with a resource modified or archived '
+                       'since its QA, or never QA\'d')
+    @click.argument('args', nargs=-1)
+    def run(args, processes, force, since, stale):
+        """QA analysis like 'update', but done directly in parallel worker
+           processes, rather than queued for the job workers"""
+        commands.run(args, processes=processes, force=force, since=since,
+                     stale=stale)
+
+    @qa.command()
+    @click.argument('run_id', required=False)
+    def progress(run_id):
+        """Shows the progress and ETA of a bulk QA run (by default the
+           latest one)"""
+        commands.progress(run_id)
+
+    @qa.command('purge-runs')
+    @click.option('--days', type=int,
+                  help='Delete runs older than this many days (default: '
+                       'ckanext.qa.run_retention_days, or 30)')
+    @click.option('--include-unfinished', is_flag=True,
+                  help='Also delete runs that have datasets not yet done')
+    def purge_runs(days, include_unfinished):
+        """Deletes old bulk QA runs (see 'progress') and their lists of
+           datasets"""
+        commands.purge_runs(days=days, include_unfinished=include_unfinished)
+
+    @qa.command()
+    @click.option('--json', 'as_json', is_flag=True, help='Output as JSON')
+    def stats(as_json):
+        """Summary of the QA results - scores, formats, age, broken links
+           and a breakdown by organization"""
+        commands.stats(as_json=as_json)
 
     @qa.command()
     @click.argument('package_ref', required=False)
@@ -48,6 +105,69 @@ def get_commands():
         """Remove all package score information"""
         commands.clean()
 
+    @qa.command()
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Number of QA rows to read and write at a time')
+    def rescore(chunk_size):
+        """Recalculates openness scores from the formats already detected,
+           e.g. after changing the format scores, without downloading
+           anything"""
+        commands.rescore(chunk_size=chunk_size)
+
+    @qa.command('rebuild-aggregates')
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Number of datasets to rebuild in each transaction')
+    def rebuild_aggregates(chunk_size):
+        """Recalculates the QA of every dataset from that of its resources
+           e.g. after upgrading"""
+        commands.rebuild_aggregates(chunk_size=chunk_size)
+
+    @qa.command('purge-orphans')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only count the rows that would be deleted')
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Number of QA rows to delete in each transaction')
+    def purge_orphans(dry_run, chunk_size):
+        """Deletes the QA results of resources and datasets that have been
+           deleted"""
+        commands.purge_orphans(dry_run=dry_run, chunk_size=chunk_size)
+
+    @qa.command()
+    @click.option('-o', '--output', default='-',
+                  help='File to write to (default: stdout)')
+    @click.option('--format', 'output_format', default='csv',
+                  type=click.Choice(['csv', 'jsonl']))
+    @click.option('--gzip', 'compress', is_flag=True,
+                  help='Compress the output with gzip')
+    @click.option('--organization', help='Only this organization (name/id)')
+    @click.option('--score', type=int, help='Only this openness score')
+    @click.option('--resource-format',
+                  help='Only resources of this format e.g. CSV')
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Number of QA rows to fetch from the database at a '
+                       'time')
+    def export(output, output_format, compress, organization, score,
+               resource_format, chunk_size):
+        """Exports QA results, with the dataset name, organization and
+           archival status, to CSV or JSON Lines. Needs Python 3."""
+        commands.export(output=output, output_format=output_format,
+                        compress=compress, organization=organization,
+                        score=score, format_=resource_format,
+                        chunk_size=chunk_size)
+
+    @qa.command('import')
+    @click.argument('filepath', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'input_format',
+                  type=click.Choice(['csv', 'jsonl']),
+                  help='Format of the file (default: from its extension)')
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Number of rows to load into the database at a time')
+    def import_(filepath, input_format, chunk_size):
+        """Loads QA results from a file written by 'export'. Needs
+           Python 3."""
+        commands.import_qa(filepath, input_format=input_format,
+                           chunk_size=chunk_size)
+
     @qa.command()
     @click.argument('args', nargs=-1)
     def sniff(args):
@@ -1,26 +1,58 @@
+import collections
+import csv
+import datetime
+import gzip
+import io
+import itertools
 import logging
+import multiprocessing
+import signal
 import six
 import sys
+import time
 import json
 
-from sqlalchemy import or_
+from sqlalchemy import func, or_, orm
 
 import ckan.model as model
+import ckan.plugins as p
+from ckan.plugins.toolkit import config
 
-from ckanext.qa import tasks
+from ckanext.qa import interfaces, lib, tasks
 from ckanext.qa.sniff_format import sniff_file_format
 
 log = logging.getLogger(__name__)
 
+# number of datasets selected from the database at a time
+SELECTION_CHUNK_SIZE = 1000
+# completed runs are kept for this many days, by default
+RUN_RETENTION_DAYS = 30
+
 
 def init_db():
     from ckanext.qa.model import init_tables
     init_tables(model.meta.engine)
 
 
-def update(args, queue):
-    packages = []
+def select(args, session, since=None, stale=False):
+    '''Works out the datasets and resources that the command line args refer
+    to - group/organization/dataset names or ids, or resource ids, or
+    everything if there are none.
+
+    The datasets can be narrowed down to those with a resource that has
+    changed (been archived or modified) since a given datetime, and/or since
+    it was last scored (or has never been scored) - see changed_package_ids.
+    Resources given by id are narrowed down in the same way.
+
+    Returns (package_queries, resources, queue, bulk) where each of the
+    package_queries is a query (in the given session) of the id and name of
+    datasets, queue is the default queue for the selection, and bulk says if
+    more than single datasets were selected.
+    '''
+    package_queries = []
+    bulk = False
     resources = []
+    queue = None
     if len(args) > 0:
         for arg in args[0:]:
             # try arg as a group id/name
@@ -29,24 +61,35 @@ def update(args, queue):
                 # group.packages() is unreliable for an organization -
                 # member objects are not definitive whereas owner_org, so
                 # get packages using owner_org
-                query = model.Session.query(model.Package)\
+                query = _package_id_query(session)\
                     .filter(
                         or_(model.Package.state == 'active',
                             model.Package.state == 'pending'))\
                     .filter_by(owner_org=group.id)
-                packages.extend(query.all())
+                package_queries.append(query)
+                bulk = True
                 if not queue:
                     queue = 'bulk'
                 continue
             elif group:
-                packages.extend(group.packages())
+                query = _package_id_query(session)\
+                    .join(model.Member,
+                          model.Member.table_id == model.Package.id)\
+                    .filter(model.Member.group_id == group.id)\
+                    .filter(model.Member.table_name == 'package')\
+                    .filter(model.Member.state == 'active')\
+                    .filter(model.Package.state == 'active')
+                package_queries.append(query)
+                bulk = True
                 if not queue:
                     queue = 'bulk'
                 continue
             # try arg as a package id/name
             pkg = model.Package.get(arg)
             if pkg:
-                packages.append(pkg)
+                package_queries.append(
+                    _package_id_query(session)
+                    .filter(model.Package.id == pkg.id))
                 if not queue:
                     queue = 'priority'
                 continue
@@ -63,34 +106,398 @@ def update(args, queue):
                 sys.exit(1)
     else:
         # all packages
-        pkgs = model.Session.query(model.Package)\
-                    .filter_by(state='active')\
-                    .order_by('name').all()
-        packages.extend(pkgs)
-        if not queue:
-            queue = 'bulk'
-    if packages:
-        log.info('Datasets to QA: %d', len(packages))
+        query = _package_id_query(session)\
+            .filter_by(state='active')
+        package_queries.append(query)
+        bulk = True
+        queue = 'bulk'
+    if since or stale:
+        changed = changed_package_ids(session, since=since, stale=stale)
+        package_queries = [query.filter(model.Package.id.in_(changed))
+                           for query in package_queries]
+        if resources:
+            changed_resource_ids = set(
+                row.id for row in
+                _changed_resources(session, model.Resource.id, since, stale)
+                .filter(model.Resource.id.in_(
+                    [resource.id for resource in resources])))
+            resources = [resource for resource in resources
+                         if resource.id in changed_resource_ids]
+    return package_queries, resources, queue, bulk
+
+
+def changed_package_ids(session, since=None, stale=False):
+    '''Returns a subquery of the ids of datasets that have an active resource
+    that has changed.
+
+    :param since: datetime (UTC) - the resource was created, modified or
+        archived since then
+    :param stale: the resource was modified or archived since its QA was
+        last checked, or has not had QA
+    '''
+    return _changed_resources(session, model.Resource.package_id,
+                              since, stale).distinct().subquery()
+
+
+def _changed_resources(session, column, since=None, stale=False):
+    '''Returns a query of the column (of Resource) for the active resources
+    that have changed - see changed_package_ids.'''
+    from ckanext.archiver.model import Archival
+    from ckanext.qa.model import QA
+    Resource = model.Resource
+    query = session.query(column)\
+        .outerjoin(Archival, Archival.resource_id == Resource.id)\
+        .filter(Resource.state == 'active')
+    if since:
+        query = query.filter(or_(Resource.created >= since,
+                                 Resource.last_modified >= since,
+                                 Archival.updated >= since))
+    if stale:
+        # a resource skipped as unchanged is checked, but not updated
+        checked = func.coalesce(QA.checked, QA.updated)
+        query = query.outerjoin(QA, QA.resource_id == Resource.id)\
+            .filter(or_(QA.id.is_(None),
+                        Resource.last_modified > checked,
+                        Archival.updated > checked))
+    return query
+
+
+def update(args, queue, force=False, batch_size=1, resume=None, since=None,
+           stale=False):
+    if resume:
+        return resume_run(resume, queue)
+    # the datasets are selected in a session of their own, so that the
+    # selection can be streamed while the run ledger is committed
+    selection_session = orm.Session(bind=model.meta.engine)
+    package_queries, resources, default_queue, bulk = \
+        select(args, selection_session, since=since, stale=stale)
+    queue = queue or default_queue
     if resources:
         log.info('Resources to QA: %d', len(resources))
-    if not (packages or resources):
-        log.error('No datasets or resources to process')
-        sys.exit(1)
 
     log.info('Queue: %s', queue)
-    for package in packages:
-        tasks.create_qa_update_package_task(package, queue)
-        log.info('Queuing dataset %s (%s resources)',
-                 package.name, len(package.resources))
+    # a run ledger is kept for anything more than a single dataset
+    needs_run = bulk or len(package_queries) > 1
+    # chunks are whole batches, so that no batch is split between chunks
+    chunk_size = batch_size * max(1, SELECTION_CHUNK_SIZE // batch_size)
+    run = None
+    package_count = 0
+    try:
+        for packages in lib.chunks(_stream(package_queries, chunk_size),
+                                   chunk_size):
+            if needs_run:
+                if run is None:
+                    run = create_run(args, queue, force, batch_size,
+                                     since=since, stale=stale)
+                run.add_packages([package.id for package in packages])
+                model.Session.commit()
+            queue_packages(packages, queue, force, batch_size,
+                           run.id if run else None)
+            package_count += len(packages)
+    finally:
+        selection_session.close()
+    if run:
+        run.package_count = package_count
+        model.Session.commit()
+    if package_count:
+        log.info('Datasets queued: %d', package_count)
+    if not (package_count or resources):
+        if since or stale:
+            log.info('No datasets have changed')
+            return
+        log.error('No datasets or resources to process')
+        sys.exit(1)
 
     for resource in resources:
-        package = resource.resource_group.package
+        package = resource.package
         log.info('Queuing resource %s/%s', package.name, resource.id)
         tasks.create_qa_update_task(resource, queue)
 
     log.info('Completed queueing')
 
 
+def _package_id_query(session):
+    return session.query(model.Package.id, model.Package.name)\
+        .order_by(model.Package.name)
+
+
+def _stream(package_queries, chunk_size):
+    # datasets selected by more than one argument are only yielded once
+    seen_ids = set() if len(package_queries) > 1 else None
+    for query in package_queries:
+        for package in query.yield_per(chunk_size):
+            if seen_ids is not None:
+                if package.id in seen_ids:
+                    continue
+                seen_ids.add(package.id)
+            yield package
+
+
+def _count_packages(package_queries):
+    '''Returns the number of datasets selected by the queries, counting
+    those selected by more than one query once, as _stream does.'''
+    id_queries = [query.with_entities(model.Package.id).order_by(None)
+                  for query in package_queries]
+    if not id_queries:
+        return 0
+    # UNION leaves out duplicates
+    return id_queries[0].union(*id_queries[1:]).count()
+
+
+def run(args, processes=None, force=False, since=None, stale=False):
+    '''Does the QA of the selected datasets and resources directly, rather
+    than queueing jobs, spread across a pool of worker processes (one per CPU
+    by default). Needs no Redis or job workers, so suits one-off audits.'''
+    from ckanext.qa.bin.running_stats import BoundedStatsList
+    selection_session = orm.Session(bind=model.meta.engine)
+    package_queries, resources, _, _ = select(
+        args, selection_session, since=since, stale=stale)
+    resource_ids = [resource.id for resource in resources]
+
+    # the workers are forked from this process, so must not inherit its
+    # database connections - drop them so each worker opens its own
+    model.Session.remove()
+    model.meta.engine.dispose()
+    context = multiprocessing.get_context('fork') if six.PY3 \
+        else multiprocessing
+    pool = context.Pool(processes, initializer=_init_run_worker)
+
+    stats = BoundedStatsList()
+    progress = _RunProgress(
+        _count_packages(package_queries) + len(resource_ids))
+    jobs = itertools.chain(
+        (('package', package.id, force)
+         for package in _stream(package_queries, SELECTION_CHUNK_SIZE)),
+        (('resource', resource_id, force) for resource_id in resource_ids))
+    try:
+        for outcome, object_id, duration, counts in pool.imap_unordered(
+                _run_job, jobs, chunksize=10):
+            stats.add(outcome, object_id)
+            stats.record_latency(outcome, duration)
+            for key, count in counts.items():
+                stats[key] = stats.get(key, 0) + count
+            progress.increment()
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        selection_session.close()
+        progress.finish()
+
+    print('QA run complete:')
+    print(stats.report())
+
+
+def _init_run_worker():
+    # Ctrl-C is handled by the parent, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_job(job):
+    '''Does the QA of a dataset or resource in a 'qa run' worker process.
+
+    Returns (outcome, id, seconds taken, dict of resource counts).'''
+    object_type, object_id, force = job
+    start = time.time()
+    counts = {}
+    try:
+        if object_type == 'package':
+            result = tasks.update_package_(object_id, force=force)
+            counts = {'Resources scored': result['scored'],
+                      'Resources skipped (unchanged)': result['skipped']}
+        else:
+            tasks.update_resource_(object_id)
+            counts = {'Resources scored': 1}
+        outcome = 'Datasets done' if object_type == 'package' \
+            else 'Resources done'
+    except Exception as e:
+        log.error('QA of %s %s failed: %s: %s', object_type, object_id,
+                  e.__class__.__name__, e)
+        model.Session.rollback()
+        outcome = 'Error: %s' % e.__class__.__name__
+    return outcome, object_id, time.time() - start, counts
+
+
+class _RunProgress(object):
+    '''Shows a live count of the jobs done by 'qa run' - updated in place on
+    a terminal, otherwise a line every PRINT_EVERY jobs.'''
+    PRINT_EVERY = 100
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.live = sys.stderr.isatty()
+
+    def line(self):
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        return '%i/%i done (%.1f%%) %.1f/s' % (
+            self.done, self.total,
+            100.0 * self.done / self.total if self.total else 100, rate)
+
+    def increment(self):
+        self.done += 1
+        if self.live:
+            sys.stderr.write('\r' + self.line())
+            sys.stderr.flush()
+        elif self.done % self.PRINT_EVERY == 0:
+            sys.stderr.write(self.line() + '\n')
+
+    def finish(self):
+        if self.live:
+            sys.stderr.write('\n')
+        else:
+            sys.stderr.write(self.line() + '\n')
+
+
+def create_run(args, queue, force, batch_size, since=None, stale=False):
+    '''Records a bulk QA run in the ledger, so it can be resumed. Add its
+    packages with run.add_packages(), then set its package_count to show
+    that they have all been added. Completed runs older than
+    ckanext.qa.run_retention_days are deleted.'''
+    from ckanext.qa.model import QARun
+    days = run_retention_days()
+    if days:
+        created_before = datetime.datetime.utcnow() - \
+            datetime.timedelta(days=days)
+        purged = QARun.purge(created_before)
+        if purged:
+            log.info('Deleted %i completed QA runs older than %i days',
+                     purged, days)
+    run = QARun(selection=json.dumps(list(args)), since=since, stale=stale,
+                queue=queue, force=force, batch_size=batch_size,
+                package_count=None)
+    model.Session.add(run)
+    model.Session.commit()
+    print('QA run %s - if interrupted, resume it with: '
+          'ckan qa update --resume %s' % (run.id, run.id))
+    return run
+
+
+def run_retention_days():
+    '''Returns how many days completed runs are kept for - 0 means
+    forever.'''
+    return int(config.get('ckanext.qa.run_retention_days',
+                          RUN_RETENTION_DAYS))
+
+
+def purge_runs(days=None, include_unfinished=False):
+    '''Deletes the ledger of runs older than the given number of days (by
+    default ckanext.qa.run_retention_days) - only completed runs, unless
+    include_unfinished.'''
+    from ckanext.qa.model import QARun
+    if days is None:
+        days = run_retention_days()
+    created_before = datetime.datetime.utcnow() - \
+        datetime.timedelta(days=days)
+    purged = QARun.purge(created_before,
+                         include_unfinished=include_unfinished)
+    model.Session.commit()
+    print('QA runs deleted: %i' % purged)
+
+
+def queue_packages(packages, queue, force, batch_size, run_id=None):
+    '''Queues QA jobs for the packages, which can be Package objects or
+    anything else with an id and name.'''
+    if batch_size > 1:
+        for i in range(0, len(packages), batch_size):
+            batch = packages[i:i + batch_size]
+            tasks.create_qa_update_packages_task(
+                [package.id for package in batch], queue, force=force,
+                run_id=run_id)
+            log.info('Queuing %i datasets %s...%s', len(batch),
+                     batch[0].name, batch[-1].name)
+    else:
+        for package in packages:
+            tasks.create_qa_update_package_task(package, queue, force=force,
+                                                run_id=run_id)
+            log.info('Queuing dataset %s', package.name)
+
+
+def resume_run(run_id, queue=None):
+    '''Queues the packages of a bulk QA run that have not completed.'''
+    from ckanext.qa.model import QARun
+    run = QARun.get(run_id)
+    if not run:
+        log.error('QA run not found: %s', run_id)
+        sys.exit(1)
+    if run.package_count is None:
+        # 'qa update' was stopped before it had selected all the datasets
+        complete_run_selection(run)
+    packages = run.unfinished_packages()
+    print('Resuming QA run %s (%s): %i of %i datasets to do' %
+          (run.id, ' '.join(json.loads(run.selection or '[]')) or 'all',
+           len(packages), run.package_count))
+    queue = queue or run.queue
+    log.info('Queue: %s', queue)
+    queue_packages(packages, queue, run.force, run.batch_size, run.id)
+    log.info('Completed queueing')
+
+
+def complete_run_selection(run):
+    '''Selects the run's datasets again, and adds those that are missing
+    from its ledger.'''
+    log.info('QA run %s was stopped before all its datasets were '
+             'selected - selecting them again', run.id)
+    selection_session = orm.Session(bind=model.meta.engine)
+    package_queries, _, _, _ = select(
+        json.loads(run.selection or '[]'), selection_session,
+        since=run.since, stale=run.stale)
+    added = 0
+    try:
+        for packages in lib.chunks(
+                _stream(package_queries, SELECTION_CHUNK_SIZE),
+                SELECTION_CHUNK_SIZE):
+            package_ids = [package.id for package in packages]
+            recorded = run.recorded_packages(package_ids)
+            missing = [id_ for id_ in package_ids if id_ not in recorded]
+            run.add_packages(missing)
+            model.Session.commit()
+            added += len(missing)
+    finally:
+        selection_session.close()
+    run.package_count = run.progress()['total']
+    model.Session.commit()
+    log.info('Added %i datasets to QA run %s', added, run.id)
+
+
+def progress(run_id=None):
+    '''Prints the progress of a bulk QA run (the latest, by default) and an
+    estimate of when it will finish.'''
+    from ckanext.qa.model import QARun
+    run = QARun.get(run_id) if run_id else QARun.latest()
+    if not run:
+        print('No QA runs found')
+        return
+    stats = run.progress()
+    total, completed = stats['total'], stats['completed']
+    print('QA run %s started %s (%s)' % (
+        run.id, run.created.strftime('%Y-%m-%d %H:%M'),
+        ' '.join(json.loads(run.selection or '[]')) or 'all datasets'))
+    print('Completed: %i of %i datasets (%.1f%%)' % (
+        completed, total, 100.0 * completed / total if total else 100))
+    if run.package_count is None:
+        print('Not all datasets have been selected yet - if "qa update" '
+              'was stopped, resume the run to select the rest')
+    if completed >= total:
+        return
+    if completed > 1:
+        elapsed = stats['last_completed'] - stats['first_completed']
+        seconds = elapsed.total_seconds()
+        if seconds > 0:
+            rate = (completed - 1) / seconds
+            eta = datetime.timedelta(seconds=int((total - completed) / rate))
+            print('Rate: %.2f datasets/s  ETA: %s (%s)' % (
+                rate, eta,
+                (datetime.datetime.utcnow() + eta).strftime('%Y-%m-%d %H:%M')))
+            return
+    print('ETA: not enough datasets completed yet to estimate')
+
+
 def view(package_ref=None):
 
     q = model.Session.query(model.TaskStatus).filter_by(task_type='qa')
@@ -107,6 +514,122 @@ def view(package_ref=None):
                       row.error))
 
 
+# (days, label) of the buckets that stats() counts the age of QA in
+STALENESS_BUCKETS = ((1, 'under 1 day'), (7, '1-7 days'), (30, '7-30 days'),
+                     (90, '30-90 days'), (365, '90-365 days'))
+
+
+def get_stats(today=None):
+    '''Returns a dict summarising the QA table, from a handful of GROUP BY
+    queries: the distribution of scores and formats, how long ago resources
+    were scored, the archiver's broken link counts, and a breakdown by
+    organization. Only the QA of active resources of active datasets is
+    counted.'''
+    from ckanext.archiver.model import Archival
+    from ckanext.qa.model import QA
+    today = today or datetime.date.today()
+    session = model.Session
+
+    def query(*columns):
+        return session.query(*columns) \
+            .join(model.Resource, model.Resource.id == QA.resource_id) \
+            .join(model.Package, model.Package.id == model.Resource.package_id) \
+            .filter(model.Resource.state == 'active') \
+            .filter(model.Package.state == 'active')
+
+    scores = dict(
+        query(QA.openness_score, func.count(QA.id))
+        .group_by(QA.openness_score).all())
+    formats = query(QA.format, func.count(QA.id)) \
+        .group_by(QA.format) \
+        .order_by(func.count(QA.id).desc()) \
+        .all()
+
+    staleness = collections.OrderedDict(
+        (label, 0) for days, label in STALENESS_BUCKETS)
+    staleness['over 1 year'] = staleness['never'] = 0
+    for date, count in query(func.date(QA.updated), func.count(QA.id)) \
+            .group_by(func.date(QA.updated)):
+        if date is None:
+            staleness['never'] += count
+            continue
+        if isinstance(date, six.string_types):  # sqlite
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+        age = (today - date).days
+        for days, label in STALENESS_BUCKETS:
+            if age < days:
+                break
+        else:
+            label = 'over 1 year'
+        staleness[label] += count
+
+    # is_broken is None when the archiver had a download or system error
+    broken = {'broken': 0, 'not broken': 0, 'archival error': 0,
+              'not archived': 0}
+    organizations = {}
+    archived = Archival.id.isnot(None)
+    for org_name, is_archived, is_broken, count, score_count, score_sum in \
+            query(model.Group.name, archived, Archival.is_broken,
+                  func.count(QA.id), func.count(QA.openness_score),
+                  func.sum(QA.openness_score)) \
+            .outerjoin(model.Group, model.Group.id == model.Package.owner_org) \
+            .outerjoin(Archival, Archival.resource_id == QA.resource_id) \
+            .group_by(model.Group.name, archived, Archival.is_broken):
+        if not is_archived:
+            broken_key = 'not archived'
+        else:
+            broken_key = {True: 'broken', False: 'not broken'}.get(
+                is_broken, 'archival error')
+        broken[broken_key] += count
+        org = organizations.setdefault(org_name, {
+            'organization': org_name, 'resources': 0, 'broken': 0,
+            'scored': 0, 'score_sum': 0})
+        org['resources'] += count
+        org['scored'] += score_count
+        org['score_sum'] += score_sum or 0
+        if is_broken:
+            org['broken'] += count
+    for org in organizations.values():
+        score_sum = org.pop('score_sum')
+        org['average_score'] = round(float(score_sum) / org['scored'], 2) \
+            if org['scored'] else None
+
+    return {
+        'total': sum(scores.values()),
+        'scores': collections.OrderedDict(
+            (str(score), count)
+            for score, count in sorted(scores.items(),
+                                       key=lambda item: (item[0] is None,
+                                                         item[0]))),
+        'formats': collections.OrderedDict(
+            (format_ or 'unknown', count) for format_, count in formats),
+        'staleness': staleness,
+        'broken': broken,
+        'organizations': sorted(
+            organizations.values(),
+            key=lambda org: (-org['resources'], org['organization'] or '')),
+    }
+
+
+def stats(as_json=False):
+    summary = get_stats()
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+    print('QA of %i resources' % summary['total'])
+    for title, key in (('Openness scores', 'scores'), ('Formats', 'formats'),
+                       ('Time since scored', 'staleness'),
+                       ('Links', 'broken')):
+        print('\n%s:' % title)
+        for category, count in summary[key].items():
+            print('\t%s: %i' % (category, count))
+    print('\nOrganizations:')
+    for org in summary['organizations']:
+        print('\t%s: %i resources, %i broken, average score %s' % (
+            org['organization'] or '(none)', org['resources'], org['broken'],
+            org['average_score']))
+
+
 def migrate():
     q_status = model.Session.query(model.TaskStatus) \
         .filter_by(task_type='qa') \
@@ -178,6 +701,296 @@ def clean():
     view()
 
 
+def _orphan_qa_query(session):
+    '''Query of the ids of QA rows whose resource is missing or no longer
+    active, or whose dataset is missing or deleted.'''
+    from ckanext.qa.model import QA
+    return session.query(QA.id, QA.package_id) \
+        .outerjoin(model.Resource, model.Resource.id == QA.resource_id) \
+        .outerjoin(model.Package, model.Package.id == QA.package_id) \
+        .filter(or_(model.Resource.id.is_(None),
+                    model.Resource.state != 'active',
+                    model.Package.id.is_(None),
+                    model.Package.state == 'deleted'))
+
+
+def purge_orphans(dry_run=False, chunk_size=1000):
+    '''Deletes the QA rows of resources and datasets that have been deleted.
+    Rows are deleted chunk_size at a time, each chunk in its own
+    transaction, so that the table is never locked for long.'''
+    from ckanext.qa.model import QA
+    if dry_run:
+        count = _orphan_qa_query(model.Session).count()
+        print('QA rows of deleted resources/datasets: %i (dry run - '
+              'nothing deleted)' % count)
+        return
+    # the ids are streamed in a session of their own, so that the deletes
+    # can be committed as it goes
+    selection_session = orm.Session(bind=model.meta.engine)
+    deleted = 0
+    package_ids = set()
+    try:
+        rows = _orphan_qa_query(selection_session).yield_per(chunk_size)
+        for chunk in lib.chunks(rows, chunk_size):
+            model.Session.query(QA) \
+                .filter(QA.id.in_([row.id for row in chunk])) \
+                .delete(synchronize_session=False)
+            model.Session.commit()
+            deleted += len(chunk)
+            package_ids.update(row.package_id for row in chunk)
+            log.info('Deleted %i orphaned QA rows so far', deleted)
+    finally:
+        selection_session.close()
+    print('QA rows of deleted resources/datasets deleted: %i' % deleted)
+    refresh_aggregates(package_ids, chunk_size=chunk_size)
+
+
+# columns of 'qa export' - those of the QA table plus some context
+EXPORT_COLUMNS = (
+    'id', 'package_id', 'package_name', 'organization', 'resource_id',
+    'resource_timestamp', 'archival_timestamp', 'openness_score',
+    'openness_score_reason', 'format', 'input_fingerprint', 'score_source',
+    'created', 'updated', 'archival_is_broken', 'archival_status')
+
+
+def export_rows(session, organization=None, score=None, format_=None,
+                chunk_size=1000):
+    '''Yields a dict per QA row (with the EXPORT_COLUMNS), streamed from
+    the database.'''
+    from ckanext.archiver.model import Archival, Status
+    from ckanext.qa.model import QA
+    Organization = orm.aliased(model.Group)
+    q = session.query(QA, model.Package.name, Organization.name,
+                      Archival.is_broken, Archival.status_id) \
+        .outerjoin(model.Package, model.Package.id == QA.package_id) \
+        .outerjoin(Organization,
+                   Organization.id == model.Package.owner_org) \
+        .outerjoin(Archival, Archival.resource_id == QA.resource_id)
+    if organization:
+        group = model.Group.get(organization)
+        if not group:
+            log.error('Organization not found: %s', organization)
+            sys.exit(1)
+        q = q.filter(model.Package.owner_org == group.id)
+    if score is not None:
+        q = q.filter(QA.openness_score == score)
+    if format_:
+        q = q.filter(func.lower(QA.format) == format_.lower())
+    for qa, package_name, org_name, is_broken, status_id in \
+            q.order_by(QA.package_id, QA.resource_id).yield_per(chunk_size):
+        row = dict((column.name, getattr(qa, column.name))
+                   for column in QA.__table__.columns)
+        row.update({
+            'package_name': package_name,
+            'organization': org_name,
+            'archival_is_broken': is_broken,
+            'archival_status': Status.by_id(status_id)
+            if status_id is not None else None,
+        })
+        yield row
+
+
+def _require_python3(command):
+    # the csv module only works with text streams on Python 3
+    if six.PY2:
+        print('"qa %s" needs Python 3' % command)
+        sys.exit(1)
+
+
+def _export_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def export(output='-', output_format='csv', compress=False,
+           organization=None, score=None, format_=None, chunk_size=1000):
+    '''Writes all the QA results (or those of an organization, score or
+    format) to a CSV or JSON Lines file, optionally gzipped. The rows are
+    streamed from a server-side cursor, so memory use stays constant.
+    Needs Python 3.'''
+    _require_python3('export')
+    if compress:
+        binary = gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb') \
+            if output == '-' else gzip.open(output, 'wb')
+        stream = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    elif output == '-':
+        stream = sys.stdout
+    else:
+        stream = io.open(output, 'w', encoding='utf-8', newline='')
+    session = orm.Session(bind=model.meta.engine)
+    count = 0
+    try:
+        if output_format == 'csv':
+            writer = csv.DictWriter(stream, EXPORT_COLUMNS)
+            writer.writeheader()
+        rows = export_rows(session, organization=organization, score=score,
+                           format_=format_, chunk_size=chunk_size)
+        for row in rows:
+            row = dict((key, _export_value(value))
+                       for key, value in row.items())
+            if output_format == 'csv':
+                writer.writerow(row)
+            else:
+                stream.write(json.dumps(row, sort_keys=True) + '\n')
+            count += 1
+    finally:
+        session.close()
+        if stream is sys.stdout:
+            stream.flush()
+        else:
+            stream.close()
+    log.info('Exported %i QA rows', count)
+
+
+def _parse_datetime(value):
+    for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, format_)
+        except ValueError:
+            pass
+    raise ValueError('Could not parse date/time: %r' % value)
+
+
+def import_rows(filepath, input_format=None):
+    '''Yields the QA rows (dicts of typed values) from a file written by
+    'qa export' - CSV or JSON Lines, gzipped or not.'''
+    from ckanext.qa.model import QA
+    name = filepath[:-3] if filepath.endswith('.gz') else filepath
+    input_format = input_format or \
+        ('jsonl' if name.endswith(('.jsonl', '.json')) else 'csv')
+    if filepath.endswith('.gz'):
+        f = io.TextIOWrapper(gzip.open(filepath, 'rb'), encoding='utf-8',
+                             newline='')
+    else:
+        f = io.open(filepath, encoding='utf-8', newline='')
+    with f:
+        rows = csv.DictReader(f) if input_format == 'csv' \
+            else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            qa_row = {}
+            for key in QA.IMPORT_COLUMNS:
+                value = row.get(key)
+                if value == '' or value is None:
+                    value = None
+                elif key == 'openness_score':
+                    value = int(value)
+                elif key in ('resource_timestamp', 'archival_timestamp',
+                             'created', 'updated'):
+                    value = _parse_datetime(value)
+                qa_row[key] = value
+            yield qa_row
+
+
+def import_qa(filepath, input_format=None, chunk_size=1000):
+    '''Loads QA results from a file written by 'qa export', e.g. to copy
+    them from another site, or restore them. Needs Python 3.'''
+    from ckanext.qa.model import QA
+    _require_python3('import')
+    counts = QA.bulk_import(import_rows(filepath, input_format),
+                            chunk_size=chunk_size)
+    model.Session.commit()
+    for outcome in ('inserted', 'updated', 'skipped'):
+        print('%s: %i' % (outcome, counts[outcome]))
+    refresh_aggregates(counts['package_ids'], chunk_size=chunk_size)
+
+
+def rescore(chunk_size=1000):
+    '''Recalculates the openness scores from the format, broken link status
+    and license, for when the format scores config or a license has
+    changed. It doesn't download or sniff any files, so it is quick. It
+    relies on qa.score_source, so scores from before that was recorded, or
+    from IQA plugins, are only changed if the link is now broken or the
+    license not open - the rest need "update --force".'''
+    from ckanext.archiver.model import Archival
+    from ckanext.qa.model import QA
+
+    if list(p.PluginImplementations(interfaces.IQA)):
+        log.warning('Custom IQA scores are not applied by rescore - '
+                    'use "update --force" for that')
+    format_scores = lib.resource_format_scores()
+    license_register = model.Package.get_license_register()
+    license_is_open = {}
+    _ = p.toolkit._
+
+    q = model.Session.query(QA.id, QA.package_id, QA.format,
+                            QA.openness_score, QA.score_source,
+                            Archival, model.Package.license_id) \
+        .join(model.Resource, model.Resource.id == QA.resource_id) \
+        .join(model.Package, model.Package.id == model.Resource.package_id) \
+        .outerjoin(Archival, Archival.resource_id == QA.resource_id) \
+        .filter(model.Resource.state == 'active') \
+        .yield_per(chunk_size)
+    counts = {'unchanged': 0, 'rescored': 0, 'format not scored': 0}
+    changes = []
+    package_ids = set()
+    for qa_id, package_id, format_, score, source, archival, license_id \
+            in q:
+        if license_id not in license_is_open:
+            license = license_register.get(license_id)
+            license_is_open[license_id] = bool(license and license.isopen())
+        # the score before the license is checked, as in resource_score
+        if archival and archival.is_broken:
+            new_source = tasks.SCORE_SOURCE_BROKEN
+            new_score = 0
+            new_reason = tasks.broken_link_error_message(archival)
+        elif source in (tasks.SCORE_SOURCE_FORMAT, tasks.SCORE_SOURCE_BROKEN):
+            # a link that is no longer broken is scored on its last format
+            if format_scores.get(format_) is None:
+                counts['format not scored'] += 1
+                continue
+            new_source = tasks.SCORE_SOURCE_FORMAT
+            new_score = format_scores[format_]
+            new_reason = _('Format "%s" receives openness score: %s. '
+                           '(Rescored without checking the file again.)') \
+                % (format_, new_score)
+        elif source == tasks.SCORE_SOURCE_UNKNOWN:
+            new_source = source
+            new_score = 1
+            new_reason = _('Could not understand the file format, '
+                           'therefore score is 1.')
+        else:
+            # not known how it was scored, so it can only go down to 0
+            new_source, new_score, new_reason = source, score, None
+        if new_score and not license_is_open[license_id]:
+            new_score, new_reason = 0, _('License not open')
+        if (new_score, new_source) == (score, source):
+            counts['unchanged'] += 1
+            continue
+        changes.append({'id': qa_id, 'openness_score': new_score,
+                        'openness_score_reason': new_reason,
+                        'score_source': new_source})
+        package_ids.add(package_id)
+        counts['rescored'] += 1
+
+    for i in range(0, len(changes), chunk_size):
+        model.Session.bulk_update_mappings(QA, changes[i:i + chunk_size])
+    model.Session.commit()
+    for outcome, count in sorted(counts.items()):
+        print('%s: %i' % (outcome, count))
+    refresh_aggregates(package_ids, chunk_size=chunk_size)
+
+
+def refresh_aggregates(package_ids, chunk_size=1000):
+    '''Recalculates the QA of the given datasets (in the qa_package table),
+    chunk_size datasets per transaction.'''
+    from ckanext.qa.model import QAPackage
+    package_ids = sorted(set(package_ids))
+    for chunk in lib.chunks(package_ids, chunk_size):
+        QAPackage.refresh(chunk)
+        model.Session.commit()
+    if package_ids:
+        print('Dataset QA aggregates refreshed: %i' % len(package_ids))
+
+
+def rebuild_aggregates(chunk_size=1000):
+    '''Recalculates the QA of every dataset (in the qa_package table) from
+    that of its resources.'''
+    from ckanext.qa.model import QAPackage
+    count = QAPackage.rebuild(chunk_size=chunk_size)
+    print('Dataset QA aggregates rebuilt: %i' % count)
+
+
 def sniff(args):
     if len(args) < 1:
         print('Not enough arguments', args)
@@ -8,13 +8,12 @@ from ckanext.qa.model import QA
 
 
 def qa_openness_stars_resource_html(resource):
-    print('-----> resource', resource)
     qa = resource.get('qa') or QA.get_for_resource(resource.get('id'))
     if not qa:
         return tk.literal('<!-- No qa info for this resource -->')
 
     if isinstance(qa, QA):
-        qa = qa.as_dict()
+        qa = qa.as_dict(exclude=QA.INTERNAL_COLUMNS)
     if not isinstance(qa, dict):
         return tk.literal('<!-- QA info was of the wrong type -->')
 
@@ -0,0 +1,298 @@
+# encoding: utf-8
+'''
+Instrumentation of QA jobs, to see where their time goes.
+
+QueryCounter counts the SQL statements a block of code executes and the time
+spent waiting for the database. QA jobs log these, and can enforce a query
+budget, so that N+1 query patterns are noticed::
+
+    # maximum statements for a package job: fixed + per resource
+    ckanext.qa.query_budget = 20
+    ckanext.qa.query_budget_per_resource = 0
+    # raise QueryBudgetExceeded rather than log a warning (e.g. in tests)
+    ckanext.qa.query_budget_strict = true
+
+span() times a stage of a QA job (archival lookup, download, libmagic, IQA
+hooks, DB commit etc). Spans nest, and carry the package_id and resource_id
+of the span they are in. When tracing is off (the default) span() returns a
+shared do-nothing context manager, so it costs next to nothing::
+
+    # 'log' - a JSON log line per span, to the ckanext.qa.tracing logger
+    # 'file' - OpenTelemetry (OTLP JSON) lines appended to a file
+    ckanext.qa.tracing = file
+    ckanext.qa.tracing.file = /var/log/ckan/qa-spans.jsonl
+'''
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from ckan.plugins.toolkit import asbool, config
+
+log = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter(object):
+    '''Context manager that counts the SQL statements executed by this thread
+    while it is active, and the time they took.'''
+
+    def __init__(self, engine=None, budget=None, strict=False, label=''):
+        if engine is None:
+            from ckan import model
+            engine = model.meta.engine
+        self.engine = engine
+        self.budget = budget
+        self.strict = strict
+        self.label = label
+        self.count = 0
+        self.db_time = 0.0
+        self.statements = []
+        self._thread_id = None
+        self._started = {}
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        if threading.current_thread().ident != self._thread_id:
+            return
+        self._started[id(cursor)] = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        started = self._started.pop(id(cursor), None)
+        if started is None:
+            return
+        self.count += 1
+        self.db_time += time.time() - started
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self._thread_id = threading.current_thread().ident
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.remove(self.engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        log.info('%s: %i SQL statements, %.3fs in the database',
+                 self.label or 'Queries', self.count, self.db_time)
+        if exc_type is None and self.budget and self.count > self.budget:
+            message = '%s: %i SQL statements exceeds the budget of %i' % \
+                (self.label or 'Queries', self.count, self.budget)
+            if self.strict:
+                raise QueryBudgetExceeded(message)
+            log.warning(message)
+        return False
+
+
+def job_query_counter(label):
+    '''Returns a QueryCounter for a QA job, that enforces the budget
+    strictly if configured to. Set its budget once it is known.'''
+    return QueryCounter(
+        strict=asbool(config.get('ckanext.qa.query_budget_strict', False)),
+        label=label)
+
+
+def package_query_budget(package):
+    '''Returns the configured query budget for the QA job of the given
+    package, or None if there isn't one.'''
+    budget = int(config.get('ckanext.qa.query_budget') or 0)
+    if not budget:
+        return None
+    return budget + len(package.resources) * \
+        int(config.get('ckanext.qa.query_budget_per_resource') or 0)
+
+
+# Tracing
+
+INHERITED_ATTRIBUTES = ('package_id', 'resource_id')
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def _random_id(num_bytes):
+    return binascii.hexlify(os.urandom(num_bytes)).decode('ascii')
+
+
+class Span(object):
+    '''A timed stage of a QA job. Use as a context manager.'''
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = _random_id(8)
+        self.trace_id = None
+        self.parent_id = None
+        self.start = self.end = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if stack:
+            parent = stack[-1]
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            for key in INHERITED_ATTRIBUTES:
+                if key in parent.attributes:
+                    self.attributes.setdefault(key, parent.attributes[key])
+        else:
+            self.trace_id = _random_id(16)
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_type is not None:
+            self.error = '%s: %s' % (exc_type.__name__, exc_value)
+        self.tracer._stack().pop()
+        try:
+            self.tracer.export(self)
+        except Exception as e:
+            log.warning('Could not export span %s: %s', self.name, e)
+        return False
+
+
+class Tracer(object):
+    '''Creates spans and writes them out when they finish.'''
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def span(self, name, attributes):
+        return Span(self, name, attributes)
+
+    def export(self, span):
+        raise NotImplementedError
+
+
+class LogTracer(Tracer):
+    '''Writes each span as a JSON log line.'''
+
+    def __init__(self, logger=None):
+        super(LogTracer, self).__init__()
+        self.logger = logger or logging.getLogger('ckanext.qa.tracing')
+
+    def export(self, span):
+        self.logger.info(json.dumps({
+            'name': span.name,
+            'trace_id': span.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'start': span.start,
+            'duration_ms': round((span.end - span.start) * 1000, 3),
+            'attributes': span.attributes,
+            'error': span.error,
+        }, default=str))
+
+
+class FileTracer(Tracer):
+    '''Appends each span to a file, one OTLP JSON document per line, as
+    written by OpenTelemetry's file exporter.'''
+
+    def __init__(self, filepath):
+        super(FileTracer, self).__init__()
+        self.filepath = filepath
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(int(span.start * 1e9)),
+            'endTimeUnixNano': str(int(span.end * 1e9)),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}}
+                           for key, value in sorted(span.attributes.items())],
+            'status': {'code': 2, 'message': span.error}
+            if span.error else {},
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name', 'value': {'stringValue': 'ckanext-qa'}}]},
+            'scopeSpans': [{'scope': {'name': 'ckanext.qa'},
+                            'spans': [otlp_span]}],
+        }]})
+        with self._lock:
+            with open(self.filepath, 'a') as f:
+                f.write(line + '\n')
+
+
+_NOT_CONFIGURED = object()
+_TRACER = _NOT_CONFIGURED
+
+
+def tracer_from_config():
+    '''Returns the Tracer configured by ckanext.qa.tracing, or None if
+    tracing is off.'''
+    mode = config.get('ckanext.qa.tracing')
+    if not mode or mode == 'false':
+        return None
+    if mode == 'log':
+        return LogTracer()
+    if mode == 'file':
+        filepath = config.get('ckanext.qa.tracing.file')
+        if not filepath:
+            raise ValueError('ckanext.qa.tracing = file needs '
+                             'ckanext.qa.tracing.file to be set')
+        return FileTracer(filepath)
+    raise ValueError('Unknown ckanext.qa.tracing: %r' % mode)
+
+
+def set_tracer(tracer):
+    '''Sets the Tracer for this process, or turns tracing off with None.'''
+    global _TRACER
+    _TRACER = tracer
+
+
+def span(name, **attributes):
+    '''Returns a context manager that times the named stage of a QA job,
+    e.g.::
+
+        with span('qa.download', resource_id=resource.id):
+            ...
+    '''
+    global _TRACER
+    if _TRACER is None:
+        return NULL_SPAN
+    if _TRACER is _NOT_CONFIGURED:
+        _TRACER = tracer_from_config()
+        if _TRACER is None:
+            return NULL_SPAN
+    return _TRACER.span(name, attributes)
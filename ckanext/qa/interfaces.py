@@ -12,9 +12,13 @@ class IQA(Interface):
     """
 
     @classmethod
-    def custom_resource_score(cls, resource, resource_score):
+    def custom_resource_score(cls, resource, resource_score, observers=None):
+        '''Calls each implementation in turn. observers can be given as a
+        list of the implementations, to save looking them up each call.'''
         result = None
-        for observer in plugins.PluginImplementations(cls):
+        if observers is None:
+            observers = plugins.PluginImplementations(cls)
+        for observer in observers:
             try:
                 result = observer.custom_resource_score(resource, resource_score)
             except Exception as ex:
@@ -1,15 +1,20 @@
 # encoding: utf-8
 
+import hashlib
+import itertools
 import json
 import logging
 import os
 import re
+import time
 
 from ckan.plugins.toolkit import config, get_action
 
 log = logging.getLogger(__name__)
 
 _RESOURCE_FORMAT_SCORES = None
+_RESOURCE_FORMAT_SCORES_FINGERPRINT = None
+_JOB_APITOKEN_CACHE = None  # (api_token, expiry time)
 
 
 def resource_format_scores():
@@ -59,6 +64,18 @@ def resource_format_scores():
     return _RESOURCE_FORMAT_SCORES
 
 
+def resource_format_scores_fingerprint():
+    ''' Returns a hash of the resource format scores, which changes whenever
+    the scores are edited.
+    '''
+    global _RESOURCE_FORMAT_SCORES_FINGERPRINT
+    if not _RESOURCE_FORMAT_SCORES_FINGERPRINT:
+        scores = json.dumps(sorted(resource_format_scores().items()))
+        _RESOURCE_FORMAT_SCORES_FINGERPRINT = \
+            hashlib.sha1(scores.encode('utf8')).hexdigest()
+    return _RESOURCE_FORMAT_SCORES_FINGERPRINT
+
+
 def munge_format_to_be_canonical(format_name):
     '''Tries some things to help try and get a resource format to match one of
     the canonical ones
@@ -75,10 +92,46 @@ def get_job_apitoken():
     Job actions require an authenticated user to perform the actions. This
     method returns the api_token set in the config file and defaults to the
     site_user.
+
+    The site_user's token is cached for this process for
+    ckanext.qa.api_token_cache_ttl seconds (default 300), to save an action
+    call and DB queries on every download.
     """
+    global _JOB_APITOKEN_CACHE
     api_token = config.get('ckan.qa.api_token', None)
     if api_token:
         return api_token
 
+    now = time.time()
+    if _JOB_APITOKEN_CACHE and _JOB_APITOKEN_CACHE[1] > now:
+        return _JOB_APITOKEN_CACHE[0]
+
     site_user = get_action('get_site_user')({'ignore_auth': True}, {})
+    ttl = int(config.get('ckanext.qa.api_token_cache_ttl', 300))
+    _JOB_APITOKEN_CACHE = (site_user["apikey"], now + ttl)
     return site_user["apikey"]
+
+
+def invalidate_job_apitoken():
+    """ Forgets the cached site_user API Token, so that the next call to
+    get_job_apitoken fetches it again. Call this when the token is rejected.
+    """
+    global _JOB_APITOKEN_CACHE
+    _JOB_APITOKEN_CACHE = None
+
+
+def get_redis_connection():
+    ''' Returns a connection to the Redis that CKAN uses for its job queues.
+    '''
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def chunks(iterable, chunk_size):
+    '''Yields lists of up to chunk_size items from the iterable.'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
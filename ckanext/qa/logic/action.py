@@ -2,7 +2,7 @@ import logging
 
 import ckan.plugins as p
 from ckanext.archiver.model import Archival
-from ckanext.qa.model import QA, aggregate_qa_for_a_dataset
+from ckanext.qa.model import QA, QAPackage, aggregate_qa_for_a_dataset
 
 log = logging.getLogger(__name__)
 _ = p.toolkit._
@@ -32,7 +32,7 @@ def qa_resource_show(context, data_dict):
         'id': res.id
     }
     return_dict['archival'] = archival.as_dict()
-    return_dict.update(qa.as_dict())
+    return_dict.update(qa.as_dict(exclude=QA.INTERNAL_COLUMNS))
     return return_dict
 
 
@@ -51,6 +51,10 @@ def qa_package_openness_show(context, data_dict):
     if not dataset:
         raise p.toolkit.ObjectNotFound
 
+    qa_package = QAPackage.get(dataset.id)
+    if qa_package:
+        return qa_package.as_dict()
+    # not aggregated yet (or no QA)
     qa_objs = QA.get_for_package(dataset.id)
     qa_dict = aggregate_qa_for_a_dataset(qa_objs)
     return qa_dict
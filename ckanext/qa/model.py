@@ -1,13 +1,15 @@
+import csv
 import uuid
 import datetime
 import six
 
-from sqlalchemy import Column
-from sqlalchemy import types
+from sqlalchemy import Column, ForeignKey
+from sqlalchemy import func, inspect, orm, text, types
 from sqlalchemy.ext.declarative import declarative_base
 
 import ckan.model as model
-from ckan.lib import dictization
+
+from ckanext.qa import lib
 
 log = __import__('logging').getLogger(__name__)
 
@@ -27,16 +29,26 @@ class QA(Base):
 
     id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
     package_id = Column(types.UnicodeText, nullable=False, index=True)
-    resource_id = Column(types.UnicodeText, nullable=False, index=True)
+    resource_id = Column(types.UnicodeText, nullable=False, index=True,
+                         unique=True)
     resource_timestamp = Column(types.DateTime)  # key to resource_revision
     archival_timestamp = Column(types.DateTime)
 
     openness_score = Column(types.Integer)
     openness_score_reason = Column(types.UnicodeText)
     format = Column(types.UnicodeText)
+    # hash of the inputs to the scoring, to skip rescoring if unchanged
+    input_fingerprint = Column(types.UnicodeText)
+    # how the score was arrived at - see tasks.SCORE_SOURCE_*
+    score_source = Column(types.UnicodeText)
 
     created = Column(types.DateTime, default=datetime.datetime.utcnow)
     updated = Column(types.DateTime, default=datetime.datetime.utcnow)
+    # when the resource was last checked, even if it was skipped as unchanged
+    checked = Column(types.DateTime)
+
+    # bookkeeping columns, left out when QA is shown to users
+    INTERNAL_COLUMNS = ('input_fingerprint', 'checked')
 
     def __repr__(self):
         summary = 'score=%s format=%s' % (self.openness_score, self.format)
@@ -46,9 +58,23 @@ class QA(Base):
         return '<QA %s /dataset/%s/resource/%s %s>' % \
             (summary, package_name, self.resource_id, details)
 
-    def as_dict(self):
-        context = {'model': model}
-        qa_dict = dictization.table_dictize(self, context)
+    def as_dict(self, exclude=()):
+        '''Returns the columns as a dict, with dates in ISO format - the same
+        as table_dictize, but without inspecting the table each time.
+
+        :param exclude: names of columns to leave out
+        '''
+        qa_dict = {}
+        # the loaded values, read directly rather than through the
+        # instrumented attributes, unless expired
+        values = self.__dict__
+        for name in QA_COLUMN_NAMES:
+            if name in exclude:
+                continue
+            value = values[name] if name in values else getattr(self, name)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            qa_dict[name] = value
         return qa_dict
 
     @classmethod
@@ -57,6 +83,17 @@ class QA(Base):
                     .filter(cls.resource_id == resource_id) \
                     .first()
 
+    @classmethod
+    def get_for_resources(cls, resource_ids):
+        '''Returns the QA objects for the given resources in one query, as a
+        dict keyed by resource_id.'''
+        if not resource_ids:
+            return {}
+        qa_objs = model.Session.query(cls) \
+            .filter(cls.resource_id.in_(resource_ids)) \
+            .all()
+        return dict((qa.resource_id, qa) for qa in qa_objs)
+
     @classmethod
     def get_for_package(cls, package_id):
         '''Returns the QA for the given package. May not be any if the package
@@ -82,6 +119,406 @@ class QA(Base):
         c.package_id = result[0]
         return c
 
+    @classmethod
+    def upsert(cls, rows):
+        '''Inserts or updates the QA rows of resources, given as dicts of
+        column values. An existing row for the resource keeps its id and
+        created date. On PostgreSQL this is a single
+        INSERT ... ON CONFLICT (resource_id) DO UPDATE statement, so there is
+        no read beforehand, and no race between workers. Does not commit.'''
+        if not rows:
+            return
+        session = model.Session
+        resource_ids = [row['resource_id'] for row in rows]
+        if session.get_bind().dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(cls.__table__).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[cls.__table__.c.resource_id],
+                set_=dict((key, stmt.excluded[key]) for key in rows[0]
+                          if key not in ('id', 'created', 'resource_id')))
+            session.execute(stmt)
+            # the upsert bypasses the ORM, so refresh any rows already loaded
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, cls) and obj.resource_id in resource_ids:
+                    session.expire(obj)
+        else:
+            existing = cls.get_for_resources(resource_ids)
+            for row in rows:
+                qa = existing.get(row['resource_id'])
+                if qa is None:
+                    session.add(cls(**row))
+                    continue
+                for key, value in row.items():
+                    if key not in ('id', 'created'):
+                        setattr(qa, key, value)
+
+    @classmethod
+    def mark_checked(cls, resource_ids, checked):
+        '''Records that the resources were checked, without changing their
+        QA, in a single UPDATE. Does not commit.'''
+        if not resource_ids:
+            return
+        model.Session.query(cls) \
+            .filter(cls.resource_id.in_(resource_ids)) \
+            .update({cls.checked: checked}, synchronize_session=False)
+
+    # columns loaded by bulk_import (package_id comes from the resource)
+    IMPORT_COLUMNS = ('id', 'resource_id', 'resource_timestamp',
+                      'archival_timestamp', 'openness_score',
+                      'openness_score_reason', 'format', 'input_fingerprint',
+                      'score_source', 'created', 'updated')
+    # an imported row with the same values for these is skipped as unchanged
+    IMPORT_COMPARED_COLUMNS = ('resource_timestamp', 'archival_timestamp',
+                               'openness_score', 'openness_score_reason',
+                               'format', 'input_fingerprint', 'score_source')
+
+    @classmethod
+    def bulk_import(cls, rows, chunk_size=1000):
+        '''Loads QA rows (dicts with the IMPORT_COLUMNS, e.g. from 'qa
+        export'), matching them to existing QA by resource_id. Rows for
+        resources not in this site, and rows that are unchanged, are skipped.
+        The last row for a resource wins.
+
+        On PostgreSQL the rows are COPYed into a temporary staging table,
+        chunk_size at a time, and merged into the qa table with one UPDATE
+        and one INSERT.
+
+        Returns a dict with the number of rows 'inserted', 'updated' and
+        'skipped', and the set of 'package_ids' whose QA changed. Does not
+        commit.'''
+        if model.Session.get_bind().dialect.name == 'postgresql':
+            return cls._bulk_import_postgresql(rows, chunk_size)
+        counts = {'inserted': 0, 'updated': 0, 'skipped': 0,
+                  'package_ids': set()}
+        for chunk in lib.chunks(rows, chunk_size):
+            resource_ids = [row['resource_id'] for row in chunk]
+            existing = cls.get_for_resources(resource_ids)
+            package_ids = dict(
+                model.Session.query(model.Resource.id,
+                                    model.Resource.package_id)
+                .filter(model.Resource.id.in_(resource_ids)))
+            for row in chunk:
+                qa = existing.get(row['resource_id'])
+                if qa is None:
+                    if row['resource_id'] not in package_ids:
+                        counts['skipped'] += 1
+                        continue
+                    qa = cls(id=row.get('id') or make_uuid(),
+                             package_id=package_ids[row['resource_id']],
+                             resource_id=row['resource_id'],
+                             created=row.get('created'))
+                    model.Session.add(qa)
+                    existing[row['resource_id']] = qa
+                    counts['inserted'] += 1
+                elif all(getattr(qa, key) == row.get(key)
+                         for key in cls.IMPORT_COMPARED_COLUMNS):
+                    counts['skipped'] += 1
+                    continue
+                else:
+                    counts['updated'] += 1
+                counts['package_ids'].add(qa.package_id)
+                for key in cls.IMPORT_COMPARED_COLUMNS + ('updated',):
+                    setattr(qa, key, row.get(key))
+            model.Session.flush()
+        return counts
+
+    @classmethod
+    def _bulk_import_postgresql(cls, rows, chunk_size):
+        connection = model.Session.connection()
+        connection.execute(text('''
+            CREATE TEMPORARY TABLE qa_import (
+                id TEXT, resource_id TEXT,
+                resource_timestamp TIMESTAMP, archival_timestamp TIMESTAMP,
+                openness_score INTEGER, openness_score_reason TEXT,
+                format TEXT, input_fingerprint TEXT, score_source TEXT,
+                created TIMESTAMP, updated TIMESTAMP
+            ) ON COMMIT DROP'''))
+        cursor = connection.connection.cursor()
+        copy_sql = 'COPY qa_import (%s) FROM STDIN WITH (FORMAT csv)' % \
+            ', '.join(cls.IMPORT_COLUMNS)
+        total = 0
+        for chunk in lib.chunks(rows, chunk_size):
+            buf = six.StringIO()
+            writer = csv.writer(buf)
+            for row in chunk:
+                writer.writerow([
+                    _csv_value(row.get(key) if key != 'id'
+                               else row.get('id') or make_uuid())
+                    for key in cls.IMPORT_COLUMNS])
+            buf.seek(0)
+            cursor.copy_expert(copy_sql, buf)
+            total += len(chunk)
+
+        # the last row for a resource wins
+        connection.execute(text('''
+            DELETE FROM qa_import a USING qa_import b
+            WHERE a.resource_id = b.resource_id AND a.ctid < b.ctid'''))
+        columns = cls.IMPORT_COMPARED_COLUMNS
+        updated = connection.execute(text('''
+            UPDATE qa SET %s, updated = s.updated
+            FROM qa_import s
+            WHERE qa.resource_id = s.resource_id
+            AND (%s) IS DISTINCT FROM (%s)
+            RETURNING qa.package_id''' % (
+            ', '.join('%s = s.%s' % (column, column) for column in columns),
+            ', '.join('qa.%s' % column for column in columns),
+            ', '.join('s.%s' % column for column in columns)))).fetchall()
+        inserted = connection.execute(text('''
+            INSERT INTO qa (id, package_id, resource_id, %s, created, updated)
+            SELECT s.id, r.package_id, s.resource_id, %s,
+                   COALESCE(s.created, s.updated, now() AT TIME ZONE 'utc'),
+                   COALESCE(s.updated, now() AT TIME ZONE 'utc')
+            FROM qa_import s JOIN resource r ON r.id = s.resource_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM qa WHERE qa.resource_id = s.resource_id)
+            RETURNING package_id''' % (
+            ', '.join(columns),
+            ', '.join('s.%s' % column for column in columns)))).fetchall()
+        return {'inserted': len(inserted), 'updated': len(updated),
+                'skipped': total - len(inserted) - len(updated),
+                'package_ids': set(row[0] for row in updated + inserted)}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+QA_COLUMN_NAMES = tuple(column.name for column in QA.__table__.columns)
+
+
+class QAPackage(Base):
+    """
+    The QA of a dataset, aggregated from that of its resources (see
+    aggregate_qa_for_a_dataset), so that it can be read with a primary key
+    lookup. It is refreshed whenever QA results are saved.
+    """
+    __tablename__ = 'qa_package'
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    openness_score = Column(types.Integer)
+    openness_score_reason = Column(types.UnicodeText)
+    updated = Column(types.DateTime)
+    resource_count = Column(types.Integer)
+    broken_count = Column(types.Integer)
+
+    @classmethod
+    def get(cls, package_id):
+        return model.Session.query(cls).get(package_id)
+
+    def as_dict(self):
+        '''Returns the same dict as aggregate_qa_for_a_dataset.'''
+        return {
+            'openness_score': self.openness_score,
+            'openness_score_reason': self.openness_score_reason,
+            'updated': self.updated.isoformat() if self.updated else None,
+        }
+
+    @classmethod
+    def refresh(cls, package_ids):
+        '''Recalculates the aggregated QA of the given packages, with a few
+        queries however many there are. Packages with no QA have their row
+        deleted. Does not commit.'''
+        from ckanext.archiver.model import Archival
+        package_ids = list(set(package_ids))
+        if not package_ids:
+            return
+        session = model.Session
+        qas_by_package = dict((package_id, []) for package_id in package_ids)
+        for qa in session.query(QA) \
+                .join(model.Resource, QA.resource_id == model.Resource.id) \
+                .filter(model.Resource.state == 'active') \
+                .filter(QA.package_id.in_(package_ids)):
+            qas_by_package[qa.package_id].append(qa)
+        broken_counts = dict(
+            session.query(Archival.package_id, func.count(Archival.id))
+            .join(model.Resource, Archival.resource_id == model.Resource.id)
+            .filter(model.Resource.state == 'active')
+            .filter(Archival.package_id.in_(package_ids))
+            .filter(Archival.is_broken.is_(True))
+            .group_by(Archival.package_id))
+        rows = []
+        for package_id, qa_objs in qas_by_package.items():
+            if not qa_objs:
+                continue
+            aggregate = _aggregate_qa(qa_objs)
+            aggregate.update(package_id=package_id,
+                             resource_count=len(qa_objs),
+                             broken_count=broken_counts.get(package_id, 0))
+            rows.append(aggregate)
+        unscored = [package_id for package_id, qa_objs
+                    in qas_by_package.items() if not qa_objs]
+        if unscored:
+            session.query(cls).filter(cls.package_id.in_(unscored)) \
+                .delete(synchronize_session=False)
+        if not rows:
+            return
+        if session.get_bind().dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(cls.__table__).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[cls.__table__.c.package_id],
+                set_=dict((key, stmt.excluded[key]) for key in rows[0]
+                          if key != 'package_id'))
+            session.execute(stmt)
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, cls) and obj.package_id in package_ids:
+                    session.expire(obj)
+        else:
+            for row in rows:
+                session.merge(cls(**row))
+
+    @classmethod
+    def rebuild(cls, chunk_size=1000):
+        '''Recalculates the aggregated QA of all packages, committing a chunk
+        of packages at a time. Returns the number of packages with QA.'''
+        session = model.Session
+        # packages whose QA has all gone
+        session.query(cls) \
+            .filter(~session.query(QA.id)
+                    .filter(QA.package_id == cls.package_id).exists()) \
+            .delete(synchronize_session=False)
+        session.commit()
+        # the ids are streamed in a session of their own, so that each chunk
+        # can be committed as it goes
+        selection_session = orm.Session(bind=model.meta.engine)
+        count = 0
+        try:
+            package_ids = selection_session.query(QA.package_id).distinct() \
+                .yield_per(chunk_size)
+            for chunk in lib.chunks(package_ids, chunk_size):
+                cls.refresh([row.package_id for row in chunk])
+                session.commit()
+                count += len(chunk)
+        finally:
+            selection_session.close()
+        return count
+
+
+class QARun(Base):
+    """
+    Ledger of a bulk QA run (e.g. 'ckan qa update' of all datasets), so that
+    an interrupted run can be resumed with only the datasets not yet done.
+    """
+    __tablename__ = 'qa_run'
+
+    id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
+    # the arguments given to 'ckan qa update', as JSON
+    selection = Column(types.UnicodeText)
+    # and its --since and --stale options
+    since = Column(types.DateTime)
+    stale = Column(types.Boolean, default=False)
+    queue = Column(types.UnicodeText)
+    force = Column(types.Boolean, default=False)
+    batch_size = Column(types.Integer, default=1)
+    # None until all the packages have been selected and added
+    package_count = Column(types.Integer)
+    created = Column(types.DateTime, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def get(cls, run_id):
+        return model.Session.query(cls).get(run_id)
+
+    @classmethod
+    def latest(cls):
+        return model.Session.query(cls) \
+            .order_by(cls.created.desc()) \
+            .first()
+
+    def add_packages(self, package_ids):
+        '''Records that the given packages are part of this run. Does not
+        commit.'''
+        if not package_ids:
+            return
+        model.Session.execute(
+            QARunPackage.__table__.insert(),
+            [{'run_id': self.id, 'package_id': package_id}
+             for package_id in package_ids])
+
+    def recorded_packages(self, package_ids):
+        '''Returns the set of the given package ids that are already part of
+        this run.'''
+        if not package_ids:
+            return set()
+        return set(
+            row.package_id for row in
+            model.Session.query(QARunPackage.package_id)
+            .filter(QARunPackage.run_id == self.id)
+            .filter(QARunPackage.package_id.in_(package_ids)))
+
+    def unfinished_packages(self):
+        '''Returns (id, name) of the run's packages that have not completed,
+        in order of name.'''
+        return model.Session.query(model.Package.id, model.Package.name) \
+            .join(QARunPackage, QARunPackage.package_id == model.Package.id) \
+            .filter(QARunPackage.run_id == self.id) \
+            .filter(QARunPackage.completed.is_(None)) \
+            .order_by(model.Package.name) \
+            .all()
+
+    def progress(self):
+        '''Returns a dict with keys: total, completed, first_completed,
+        last_completed.'''
+        total, completed, first_completed, last_completed = \
+            model.Session.query(
+                func.count(QARunPackage.package_id),
+                func.count(QARunPackage.completed),
+                func.min(QARunPackage.completed),
+                func.max(QARunPackage.completed)) \
+            .filter(QARunPackage.run_id == self.id) \
+            .one()
+        return {'total': total, 'completed': completed,
+                'first_completed': first_completed,
+                'last_completed': last_completed}
+
+    @classmethod
+    def purge(cls, created_before, include_unfinished=False):
+        '''Deletes the runs created before the given datetime, with their
+        packages - only runs whose packages have all completed, unless
+        include_unfinished. Returns the number of runs deleted. Does not
+        commit.'''
+        session = model.Session
+        query = session.query(cls.id).filter(cls.created < created_before)
+        if not include_unfinished:
+            unfinished = session.query(QARunPackage.run_id) \
+                .filter(QARunPackage.completed.is_(None))
+            query = query.filter(~cls.id.in_(unfinished)) \
+                .filter(cls.package_count.isnot(None))
+        run_ids = [row.id for row in query]
+        for chunk in lib.chunks(run_ids, 1000):
+            session.query(QARunPackage) \
+                .filter(QARunPackage.run_id.in_(chunk)) \
+                .delete(synchronize_session=False)
+            session.query(cls).filter(cls.id.in_(chunk)) \
+                .delete(synchronize_session=False)
+        return len(run_ids)
+
+
+class QARunPackage(Base):
+    """
+    A package in a QARun, and when its QA completed.
+    """
+    __tablename__ = 'qa_run_package'
+
+    run_id = Column(types.UnicodeText, ForeignKey('qa_run.id'),
+                    primary_key=True)
+    package_id = Column(types.UnicodeText, primary_key=True)
+    completed = Column(types.DateTime)
+
+    @classmethod
+    def mark_completed(cls, run_id, package_ids):
+        '''Records that QA has completed for the given packages in the run.
+        Does not commit.'''
+        model.Session.query(cls) \
+            .filter(cls.run_id == run_id) \
+            .filter(cls.package_id.in_(package_ids)) \
+            .update({'completed': datetime.datetime.utcnow()},
+                    synchronize_session=False)
+
 
 def aggregate_qa_for_a_dataset(qa_objs):
     '''Returns aggregated archival info for a dataset, given the archivals for
@@ -94,6 +531,13 @@ def aggregate_qa_for_a_dataset(qa_objs):
                 openness_score_reason
                 updated
     '''
+    qa_dict = _aggregate_qa(qa_objs)
+    if qa_dict['updated']:
+        qa_dict['updated'] = qa_dict['updated'].isoformat()
+    return qa_dict
+
+
+def _aggregate_qa(qa_objs):
     qa_dict = {'openness_score': None, 'openness_score_reason': None,
                'updated': None}
     for qa in qa_objs:
@@ -107,11 +551,57 @@ def aggregate_qa_for_a_dataset(qa_objs):
         if qa_dict['updated'] is None or \
                 qa.updated > qa_dict['updated']:
             qa_dict['updated'] = qa.updated
-    if qa_dict['updated']:
-        qa_dict['updated'] = qa_dict['updated'].isoformat()
     return qa_dict
 
 
 def init_tables(engine):
     Base.metadata.create_all(engine)
+    migrate_tables(engine)
     log.info('QA database tables are set-up')
+
+
+def migrate_tables(engine):
+    '''Adds any columns and constraints that are missing from QA tables
+    created by an earlier version.'''
+    inspector = inspect(engine)
+    existing_columns = set(column['name'] for column in
+                           inspector.get_columns(QA.__tablename__))
+    resource_id_is_unique = any(
+        index['unique'] and index['column_names'] == ['resource_id']
+        for index in inspector.get_indexes(QA.__tablename__))
+    existing_run_columns = set(column['name'] for column in
+                               inspector.get_columns(QARun.__tablename__))
+    with engine.begin() as connection:
+        for column, type_ in (('since', 'TIMESTAMP'), ('stale', 'BOOLEAN')):
+            if column not in existing_run_columns:
+                connection.execute(text(
+                    'ALTER TABLE qa_run ADD COLUMN %s %s' % (column, type_)))
+                log.info('Added column qa_run.%s', column)
+        if 'input_fingerprint' not in existing_columns:
+            connection.execute(text(
+                'ALTER TABLE qa ADD COLUMN input_fingerprint TEXT'))
+            log.info('Added column qa.input_fingerprint')
+        if 'score_source' not in existing_columns:
+            connection.execute(text(
+                'ALTER TABLE qa ADD COLUMN score_source TEXT'))
+            log.info('Added column qa.score_source')
+        if 'checked' not in existing_columns:
+            connection.execute(text(
+                'ALTER TABLE qa ADD COLUMN checked TIMESTAMP'))
+            log.info('Added column qa.checked')
+        if not resource_id_is_unique:
+            # earlier versions could save more than one row for a resource -
+            # keep the latest
+            deleted = connection.execute(text('''
+                DELETE FROM qa WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, row_number() OVER (
+                            PARTITION BY resource_id
+                            ORDER BY updated DESC NULLS LAST, id DESC) AS rank
+                        FROM qa) AS ranked
+                    WHERE rank > 1)''')).rowcount
+            log.info('Deleted %i duplicate QA rows', deleted)
+            connection.execute(text('DROP INDEX IF EXISTS ix_qa_resource_id'))
+            connection.execute(text(
+                'CREATE UNIQUE INDEX ix_qa_resource_id ON qa (resource_id)'))
+            log.info('Made qa.resource_id unique')
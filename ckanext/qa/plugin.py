@@ -51,7 +51,10 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
         dataset = model.Package.get(dataset_id)
         assert dataset
 
-        tasks.create_qa_update_package_task(dataset, queue=queue)
+        coalesce = p.toolkit.asbool(
+            p.toolkit.config.get('ckanext.qa.coalesce_jobs', True))
+        tasks.create_qa_update_package_task(dataset, queue=queue,
+                                            coalesce=coalesce)
 
     # IReport
 
@@ -106,14 +109,11 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, p.toolkit.DefaultDatasetForm, Def
         pkg_dict['qa'] = dataset_qa
         # resources
         qa_by_res_id = dict((a.resource_id, a) for a in qa_objs)
+        exclude = ('id', 'package_id', 'resource_id') + QA.INTERNAL_COLUMNS
         for res in pkg_dict['resources']:
             qa = qa_by_res_id.get(res['id'])
             if qa:
-                qa_dict = qa.as_dict()
-                del qa_dict['id']
-                del qa_dict['package_id']
-                del qa_dict['resource_id']
-                res['qa'] = qa_dict
+                res['qa'] = qa.as_dict(exclude=exclude)
 
     def before_index(self, pkg_dict):
         return self.before_dataset_index(pkg_dict)
@@ -0,0 +1,362 @@
+# encoding: utf-8
+'''
+Per-host rate limiting and concurrency caps for the files QA downloads.
+
+When many workers run QA at once they all fetch from the same archiver cache
+host or publisher servers. Without limits that produces 429s and timeouts,
+which are then scored as failures. Each host gets a token bucket (requests per
+second, with a burst allowance) and a cap on simultaneous downloads.
+
+Two backends are provided:
+
+* ``memory`` - limits are shared by the threads of one worker process only
+* ``redis`` - limits are shared by every worker connected to CKAN's Redis
+
+Config options::
+
+    # default requests per second per host (0 or unset = unlimited)
+    ckanext.qa.download_rate_limit = 2
+    # default number of requests that may be made in a burst
+    ckanext.qa.download_rate_burst = 4
+    # default maximum simultaneous downloads per host (0 or unset = unlimited)
+    ckanext.qa.download_max_concurrent_per_host = 4
+    # per-host overrides: host=rate[:concurrency[:burst]]
+    ckanext.qa.download_host_limits = cache.example.com=20:16 slow.example.org=0.5:1
+    # memory (default) or redis
+    ckanext.qa.download_limiter = redis
+    # seconds to wait for a concurrency slot before downloading anyway
+    ckanext.qa.download_slot_timeout = 300
+'''
+import contextlib
+import logging
+import threading
+import time
+import uuid
+
+import six.moves.urllib.parse as urlparse
+
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = 'ckanext-qa:download-limit'
+# How long a Redis concurrency slot is leased for, so it is freed if a worker
+# dies holding it
+SLOT_TTL = 600
+POLL_INTERVAL = 0.1
+# Default seconds to wait for a concurrency slot before going ahead anyway
+SLOT_TIMEOUT = 300
+
+
+class HostLimit(object):
+    '''The limits that apply to one host.'''
+
+    def __init__(self, rate=0, concurrency=0, burst=None):
+        self.rate = float(rate or 0)
+        self.concurrency = int(concurrency or 0)
+        if burst is None:
+            burst = max(1, self.rate)
+        self.burst = float(burst)
+
+    @property
+    def is_unlimited(self):
+        return not self.rate and not self.concurrency
+
+    def __eq__(self, other):
+        return (self.rate, self.concurrency, self.burst) == \
+            (other.rate, other.concurrency, other.burst)
+
+    def __repr__(self):
+        return '<HostLimit rate=%s concurrency=%s burst=%s>' % \
+            (self.rate, self.concurrency, self.burst)
+
+
+def parse_host_limits(value):
+    '''Parses the ckanext.qa.download_host_limits option.
+
+    :param value: space separated ``host=rate[:concurrency[:burst]]`` items
+    :returns: dict of HostLimit keyed by (lowercase) host
+    '''
+    limits = {}
+    for item in (value or '').split():
+        try:
+            host, spec = item.split('=', 1)
+            parts = spec.split(':')
+            rate = float(parts[0]) if parts[0] else 0
+            concurrency = int(parts[1]) if len(parts) > 1 and parts[1] else 0
+            burst = float(parts[2]) if len(parts) > 2 and parts[2] else None
+        except ValueError:
+            raise ValueError('Invalid ckanext.qa.download_host_limits item '
+                             '%r - expected host=rate[:concurrency[:burst]]'
+                             % item)
+        limits[host.lower()] = HostLimit(rate, concurrency, burst)
+    return limits
+
+
+def host_for_url(url):
+    return (urlparse.urlsplit(url).hostname or '').lower()
+
+
+class HostLimiter(object):
+    '''Base class - holds the limit configuration and does nothing.'''
+
+    def __init__(self, default_limit=None, host_limits=None,
+                 clock=time.time, sleep=time.sleep,
+                 slot_timeout=SLOT_TIMEOUT):
+        self.default_limit = default_limit or HostLimit()
+        self.host_limits = host_limits or {}
+        self.slot_timeout = slot_timeout
+        self._clock = clock
+        self._sleep = sleep
+
+    def limit_for(self, host):
+        return self.host_limits.get(host, self.default_limit)
+
+    def throttle(self, url):
+        '''Blocks until a request to the url's host is allowed by the rate
+        limit. Returns the number of seconds waited.'''
+        host = host_for_url(url)
+        limit = self.limit_for(host)
+        if not limit.rate:
+            return 0
+        wait = self._reserve_token(host, limit)
+        if wait > 0:
+            log.debug('Rate limiting %s - waiting %.2fs', host, wait)
+            self._sleep(wait)
+        return wait
+
+    def acquire(self, url):
+        '''Takes one of the url host's concurrent download slots, waiting
+        for one if they are all in use (for up to slot_timeout seconds).
+        Returns a Slot, which must be released.'''
+        host = host_for_url(url)
+        limit = self.limit_for(host)
+        token = self._acquire_slot(host, limit) if limit.concurrency \
+            else None
+        return Slot(self, host, token)
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        '''Context manager that holds one of the url host's concurrent
+        download slots for the duration of the block.'''
+        slot = self.acquire(url)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def _slot_wait_timed_out(self, host, started):
+        waited = self._clock() - started
+        if self.slot_timeout is not None and waited >= self.slot_timeout:
+            log.warning('No download slot for %s after %is - '
+                        'downloading anyway', host, waited)
+            return True
+        return False
+
+    @staticmethod
+    def _refill(tokens, stamp, now, limit):
+        '''Token bucket arithmetic shared by the backends. Tokens may go
+        negative - that is a reservation the caller waits out.'''
+        if tokens is None:
+            tokens = limit.burst
+        else:
+            tokens = min(limit.burst, tokens + (now - stamp) * limit.rate)
+        tokens -= 1
+        wait = -tokens / limit.rate if tokens < 0 else 0
+        return tokens, wait
+
+    def _reserve_token(self, host, limit):
+        return 0
+
+    def _acquire_slot(self, host, limit):
+        '''Returns a token to release the slot with, or None if no slot was
+        taken.'''
+        return None
+
+    def _renew_slot(self, host, token, now):
+        pass
+
+    def _release_slot(self, host, token):
+        pass
+
+
+class Slot(object):
+    '''A download slot taken with HostLimiter.acquire().'''
+
+    def __init__(self, limiter, host, token):
+        self.limiter = limiter
+        self.host = host
+        # None if no slot was taken (no limit, or the wait timed out)
+        self.token = token
+        self.renewed = limiter._clock()
+
+    def renew(self):
+        '''Extends the slot's lease once half of it has passed, so that a
+        long download keeps its slot. Cheap to call often.'''
+        if self.token is None:
+            return
+        now = self.limiter._clock()
+        if now - self.renewed >= SLOT_TTL / 2.0:
+            self.limiter._renew_slot(self.host, self.token, now)
+            self.renewed = now
+
+    def release(self):
+        if self.token is not None:
+            self.limiter._release_slot(self.host, self.token)
+            self.token = None
+
+
+class MemoryHostLimiter(HostLimiter):
+    '''Limits shared within this process.'''
+
+    def __init__(self, *args, **kwargs):
+        super(MemoryHostLimiter, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._buckets = {}  # {host: (tokens, stamp)}
+        self._semaphores = {}
+
+    def _reserve_token(self, host, limit):
+        with self._lock:
+            now = self._clock()
+            tokens, stamp = self._buckets.get(host, (None, now))
+            tokens, wait = self._refill(tokens, stamp, now, limit)
+            self._buckets[host] = (tokens, now)
+        return wait
+
+    def _semaphore(self, host, limit):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = \
+                    threading.BoundedSemaphore(limit.concurrency)
+            return self._semaphores[host]
+
+    def _acquire_slot(self, host, limit):
+        semaphore = self._semaphore(host, limit)
+        started = self._clock()
+        while not semaphore.acquire(False):
+            if self._slot_wait_timed_out(host, started):
+                return None
+            self._sleep(POLL_INTERVAL)
+        return True
+
+    def _release_slot(self, host, token):
+        self._semaphores[host].release()
+
+
+class RedisHostLimiter(HostLimiter):
+    '''Limits shared by all workers using the same Redis.'''
+
+    def __init__(self, redis_conn, *args, **kwargs):
+        super(RedisHostLimiter, self).__init__(*args, **kwargs)
+        self.redis = redis_conn
+
+    def _key(self, kind, host):
+        return '%s:%s:%s' % (REDIS_KEY_PREFIX, kind, host)
+
+    def _reserve_token(self, host, limit):
+        import redis
+        key = self._key('bucket', host)
+        # keep the bucket around long enough to refill completely
+        ttl = int(limit.burst / limit.rate) + 60
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    tokens, stamp = pipe.hmget(key, 'tokens', 'stamp')
+                    now = self._clock()
+                    tokens = float(tokens) if tokens is not None else None
+                    stamp = float(stamp) if stamp is not None else now
+                    tokens, wait = self._refill(tokens, stamp, now, limit)
+                    pipe.multi()
+                    pipe.hset(key, mapping={'tokens': tokens, 'stamp': now})
+                    pipe.expire(key, ttl)
+                    pipe.execute()
+                    return wait
+                except redis.WatchError:
+                    # another worker took a token at the same time - retry
+                    continue
+
+    def _acquire_slot(self, host, limit):
+        '''Leases a slot, as a member of a sorted set scored by its expiry,
+        so that the slots of dead workers expire. Gives up waiting after
+        slot_timeout seconds, and goes ahead without a slot.'''
+        import redis
+        key = self._key('slots', host)
+        token = uuid.uuid4().hex
+        started = self._clock()
+        with self.redis.pipeline() as pipe:
+            while True:
+                now = self._clock()
+                try:
+                    pipe.watch(key)
+                    pipe.zremrangebyscore(key, '-inf', now)
+                    in_use = pipe.zcard(key)
+                    if in_use < limit.concurrency:
+                        pipe.multi()
+                        pipe.zadd(key, {token: now + SLOT_TTL})
+                        pipe.expire(key, SLOT_TTL)
+                        pipe.execute()
+                        return token
+                    pipe.unwatch()
+                except redis.WatchError:
+                    # another worker took or freed a slot - retry
+                    continue
+                if self._slot_wait_timed_out(host, started):
+                    return None
+                self._sleep(POLL_INTERVAL)
+
+    def _renew_slot(self, host, token, now):
+        # only if the lease hasn't already expired and been taken
+        key = self._key('slots', host)
+        with self.redis.pipeline() as pipe:
+            pipe.zadd(key, {token: now + SLOT_TTL}, xx=True)
+            pipe.expire(key, SLOT_TTL)
+            pipe.execute()
+
+    def _release_slot(self, host, token):
+        self.redis.zrem(self._key('slots', host), token)
+
+
+_LIMITER = None
+
+
+def limiter_from_config(redis_conn=None):
+    '''Returns a HostLimiter configured from the CKAN config.'''
+    rate = float(config.get('ckanext.qa.download_rate_limit') or 0)
+    burst = config.get('ckanext.qa.download_rate_burst')
+    concurrency = int(
+        config.get('ckanext.qa.download_max_concurrent_per_host') or 0)
+    default_limit = HostLimit(rate, concurrency,
+                              float(burst) if burst else None)
+    host_limits = parse_host_limits(
+        config.get('ckanext.qa.download_host_limits'))
+    backend = config.get('ckanext.qa.download_limiter', 'memory')
+    slot_timeout = float(config.get('ckanext.qa.download_slot_timeout',
+                                    SLOT_TIMEOUT))
+    if default_limit.is_unlimited and not host_limits:
+        return HostLimiter()
+    if backend == 'redis':
+        if redis_conn is None:
+            from ckanext.qa.lib import get_redis_connection
+            redis_conn = get_redis_connection()
+        return RedisHostLimiter(redis_conn, default_limit, host_limits,
+                                slot_timeout=slot_timeout)
+    elif backend != 'memory':
+        raise ValueError('Unknown ckanext.qa.download_limiter: %r' % backend)
+    return MemoryHostLimiter(default_limit, host_limits)
+
+
+def get_limiter():
+    '''Returns the HostLimiter for this process, creating it from the config
+    on first use.'''
+    global _LIMITER
+    if _LIMITER is None:
+        _LIMITER = limiter_from_config()
+    return _LIMITER
+
+
+def set_limiter(limiter):
+    '''Replaces the process's HostLimiter (or resets it, if None is given).
+    Useful in tests.'''
+    global _LIMITER
+    _LIMITER = limiter
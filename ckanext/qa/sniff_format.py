@@ -13,7 +13,7 @@ import zipfile
 
 from ckan.plugins import toolkit
 
-from . import lib
+from . import instrumentation, lib
 
 
 log = logging.getLogger(__name__)
@@ -50,7 +50,8 @@ def sniff_file_format(filepath):
     log.info('Sniffing file format of: %s', filepath)
     filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, six.string_types) \
         else filepath
-    mime_type = magic.from_file(filepath_utf8, mime=True)
+    with instrumentation.span('qa.libmagic'):
+        mime_type = magic.from_file(filepath_utf8, mime=True)
     log.info('Magic detects file as: %s', mime_type)
     if mime_type:
         # some operating systems magic mime xml as text/xml
@@ -3,10 +3,12 @@ Provide some Quality Assurance by scoring datasets against Sir Tim
 Berners-Lee\'s five stars of openness
 '''
 import datetime
+import hashlib
 import json
 import math
 import os
 import six
+import sys
 import tempfile
 import time
 import traceback
@@ -14,12 +16,15 @@ import traceback
 import six.moves.urllib.parse as urlparse
 
 import requests
+from sqlalchemy import exc as sqlalchemy_exc
 
 from ckan.common import _
+from ckan.plugins import PluginImplementations
 from ckan.plugins.toolkit import config, enqueue_job, h as ckan_helpers
 
 from ckanext.archiver.model import Archival, Status
-from . import interfaces as qa_interfaces, lib, sniff_format
+from . import instrumentation, interfaces as qa_interfaces, lib, rate_limit, \
+    sniff_format
 
 import logging
 
@@ -29,6 +34,16 @@ SSL_VERIFY = True
 MAX_CONTENT_LENGTH = int(config.get('ckanext.qa.max_content_length', 1e7))
 CHUNK_SIZE = 16 * 1024  # 16kb
 DOWNLOAD_TIMEOUT = 30
+# Change this when a change to the scoring code means every resource should
+# be rescored, even if its inputs are unchanged
+INPUT_FINGERPRINT_VERSION = 1
+PENDING_PACKAGE_KEY_PREFIX = 'ckanext-qa:pending-package'
+COALESCED_COUNT_KEY = 'ckanext-qa:coalesced-count'
+# How a score was arrived at (before the license is checked), stored in
+# qa.score_source so that 'qa rescore' can recalculate it
+SCORE_SOURCE_FORMAT = 'format'  # looked up from the detected format
+SCORE_SOURCE_BROKEN = 'broken'  # the link is broken
+SCORE_SOURCE_UNKNOWN = 'unknown'  # the format wasn't recognised
 
 
 class QAError(Exception):
@@ -46,36 +61,132 @@ OPENNESS_SCORE_DESCRIPTION = {
 }
 
 
-def update_package(ckan_ini_filepath=None, package_id=None):
+def update_package(ckan_ini_filepath=None, package_id=None, force=False,
+                   run_id=None):
     """
     Given a package, calculates an openness score for each of its resources.
     It is more efficient to call this than 'update' for each resource.
 
+    Resources whose scoring inputs are unchanged since they were last scored
+    are skipped, unless force is True.
+
+    If run_id is given, the package is marked as done in that QARun.
+
     Returns None
     """
+    # from now on, changes to the package need another job to pick them up
+    release_pending_package(package_id)
     try:
-        update_package_(package_id)
+        update_package_(package_id, force=force)
     except Exception as e:
         log.error('Exception occurred during QA update_package: %s: %s',
                   e.__class__.__name__, e)
         raise
+    if run_id:
+        mark_run_packages_completed(run_id, [package_id])
+
+
+def update_packages(ckan_ini_filepath=None, package_ids=None, force=False,
+                    run_id=None):
+    """
+    Given a batch of packages, calculates an openness score for each of their
+    resources. Running one job per batch saves the per-job overhead when
+    doing QA on a large number of packages.
 
+    An error with one package is logged and the rest of the batch carries
+    on. If run_id is given, each package that succeeds is marked as done in
+    that QARun.
 
-def update_package_(package_id):
+    Returns None
+    """
+    from ckan import model
+    package_ids = package_ids or []
+    failed = []
+    for package_id in package_ids:
+        try:
+            update_package_(package_id, force=force)
+        except Exception as e:
+            log.error('Exception occurred during QA update_packages for '
+                      'package %s: %s: %s\n%s', package_id,
+                      e.__class__.__name__, e, traceback.format_exc())
+            model.Session.rollback()
+            failed.append(package_id)
+            continue
+        if run_id:
+            mark_run_packages_completed(run_id, [package_id])
+    log.info('QA of batch complete: %i packages ok, %i failed %r',
+             len(package_ids) - len(failed), len(failed), failed)
+
+
+def mark_run_packages_completed(run_id, package_ids):
+    '''Records in the QARun ledger that the packages' QA is done.'''
     from ckan import model
-    package = model.Package.get(package_id)
-    if not package:
-        raise QAError('Package ID not found: %s' % package_id)
+    from ckanext.qa.model import QARunPackage
+    QARunPackage.mark_completed(run_id, package_ids)
+    model.Session.commit()
+
 
-    log.info('Openness scoring package %s (%i resources)', package.name,
-             len(package.resources))
+def update_package_(package_id, force=False):
+    """
+    Scores the package's resources and saves the results.
+
+    The SQL statements are counted and logged, and checked against any
+    configured query budget - see ckanext.qa.instrumentation.
 
-    for resource in package.resources:
-        qa_result = resource_score(resource)
-        log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
-                 resource.url)
-        save_qa_result(resource, qa_result)
-        log.info('CKAN updated with openness score')
+    Returns a dict with the number of resources 'scored' and 'skipped' (as
+    unchanged).
+    """
+    from ckan import model
+    with instrumentation.job_query_counter(
+            'QA of package %s' % package_id) as query_counter, \
+            instrumentation.span('qa.update_package', package_id=package_id):
+        package = model.Package.get(package_id)
+        if not package:
+            raise QAError('Package ID not found: %s' % package_id)
+        query_counter.budget = instrumentation.package_query_budget(package)
+
+        log.info('Openness scoring package %s (%i resources)', package.name,
+                 len(package.resources))
+
+        scoring_context = ScoringContext.for_package(package)
+        counts = {'scored': 0, 'skipped': 0}
+        qa_results = []
+        unchanged_resource_ids = []
+        try:
+            for resource in package.resources:
+                fingerprint = scoring_context.input_fingerprint(resource)
+                qa = scoring_context.get_qa(resource.id)
+                if not force and qa and qa.input_fingerprint == fingerprint:
+                    log.info('Skipping resource %s - unchanged since it was '
+                             'scored', resource.id)
+                    unchanged_resource_ids.append(resource.id)
+                    counts['skipped'] += 1
+                    continue
+                qa_result = resource_score(resource, scoring_context)
+                if not qa_result.get('transient_error'):
+                    qa_result['input_fingerprint'] = fingerprint
+                log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result,
+                         resource, resource.url)
+                qa_results.append((resource, qa_result))
+                counts['scored'] += 1
+        except Exception as e:
+            exc_info = sys.exc_info()
+            # save what was scored, even if a later resource failed - unless
+            # it was a database error, which leaves the transaction unusable
+            if not isinstance(e, sqlalchemy_exc.SQLAlchemyError) and \
+                    model.Session.is_active:
+                try:
+                    save_qa_results(package, qa_results,
+                                    unchanged_resource_ids)
+                except Exception as save_error:
+                    log.error('Could not save the QA results scored before '
+                              'the error: %s: %s',
+                              save_error.__class__.__name__, save_error)
+            six.reraise(*exc_info)
+        save_qa_results(package, qa_results, unchanged_resource_ids)
+        log.info('CKAN updated with openness scores: %(scored)i scored, '
+                 '%(skipped)i skipped as unchanged', counts)
+    return counts
 
 
 def update(ckan_ini_filepath=None, resource_id=None):
@@ -100,7 +211,11 @@ def update_resource_(resource_id):
     resource = model.Resource.get(resource_id)
     if not resource:
         raise QAError('Resource ID not found: %s' % resource_id)
-    qa_result = resource_score(resource)
+    scoring_context = ScoringContext()
+    qa_result = resource_score(resource, scoring_context)
+    if not qa_result.get('transient_error'):
+        qa_result['input_fingerprint'] = \
+            scoring_context.input_fingerprint(resource)
     log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
              resource.url)
     save_qa_result(resource, qa_result)
@@ -109,10 +224,96 @@ def update_resource_(resource_id):
     return json.dumps(qa_result)
 
 
-def get_qa_format(resource_id):
+class ScoringContext(object):
+    '''Lookups shared by the scoring of a package's resources.
+
+    Created with for_package(), the Archival and QA rows of all the package's
+    resources are fetched up-front in two queries, rather than in several
+    queries per resource. Created without prefetched rows, each lookup
+    queries for just that resource.
+
+    Other per-package work is done once and remembered: the licence openness
+    decision, the IQA plugins and the scoring config part of the input
+    fingerprint.
+    '''
+
+    def __init__(self, archivals=None, qas=None):
+        # dicts keyed by resource_id, or None if not prefetched
+        self.archivals = archivals
+        self.qas = qas
+        self._package_is_open = {}  # {package_id: bool}
+        self._iqa_plugins = None
+        self._scoring_config = None
+
+    @property
+    def iqa_plugins(self):
+        if self._iqa_plugins is None:
+            self._iqa_plugins = list(PluginImplementations(qa_interfaces.IQA))
+        return self._iqa_plugins
+
+    def package_is_open(self, package):
+        if package.id not in self._package_is_open:
+            self._package_is_open[package.id] = package.isopen()
+        return self._package_is_open[package.id]
+
+    def _get_scoring_config(self):
+        if self._scoring_config is None:
+            self._scoring_config = [
+                INPUT_FINGERPRINT_VERSION,
+                lib.resource_format_scores_fingerprint(),
+                sorted(plugin.__class__.__name__
+                       for plugin in self.iqa_plugins),
+            ]
+        return self._scoring_config
+
+    @classmethod
+    def for_package(cls, package):
+        from ckan import model
+        from ckanext.qa.model import QA
+        resource_ids = [resource.id for resource in package.resources]
+        archivals = {}
+        with instrumentation.span('qa.prefetch', package_id=package.id):
+            if resource_ids:
+                archivals = dict(
+                    (archival.resource_id, archival)
+                    for archival in model.Session.query(Archival)
+                    .filter(Archival.resource_id.in_(resource_ids)))
+            qas = QA.get_for_resources(resource_ids)
+        return cls(archivals=archivals, qas=qas)
+
+    def get_archival(self, resource_id):
+        if self.archivals is None:
+            return Archival.get_for_resource(resource_id=resource_id)
+        return self.archivals.get(resource_id)
+
+    def get_qa(self, resource_id):
+        if self.qas is None:
+            from ckanext.qa.model import QA
+            return QA.get_for_resource(resource_id)
+        return self.qas.get(resource_id)
+
+    def input_fingerprint(self, resource):
+        '''Returns a hash of everything the resource's score depends on: its
+        archival, URL and format field, the package licence and the scoring
+        configuration. If it matches the one stored with the resource's QA,
+        rescoring would give the same result.'''
+        archival = self.get_archival(resource.id)
+        package = resource.package
+        inputs = self._get_scoring_config() + [
+            archival.updated.isoformat()
+            if archival and archival.updated else None,
+            resource.url,
+            resource.format,
+            package.license_id,
+            self.package_is_open(package),
+        ]
+        return hashlib.sha1(
+            json.dumps(inputs).encode('utf8')).hexdigest()
+
+
+def get_qa_format(resource_id, scoring_context=None):
     '''Returns the format of the resource, as recorded in the QA table.'''
-    from ckanext.qa.model import QA
-    q = QA.get_for_resource(resource_id)
+    q = (scoring_context or ScoringContext()).get_qa(resource_id)
     if not q:
         return ''
     return q.format
@@ -132,31 +333,51 @@ def format_get(key):
     return format_tuple[1]  # short name
 
 
-def resource_score(resource):
+def resource_score(resource, scoring_context=None):
     """
     Score resource on Sir Tim Berners-Lee\'s five stars of openness.
 
+    scoring_context is a ScoringContext holding the package's prefetched
+    Archival and QA rows. If not given, they are queried for this resource.
+
     Returns a dict with keys:
 
         'openness_score': score (int)
         'openness_score_reason': the reason for the score (string)
         'format': format of the data (string)
         'archival_timestamp': time of the archival that this result is based on (iso string)
+        'transient_error': whether the file could not be downloaded due to an
+            error that may not happen next time, so it should be rescored
+            even if nothing has changed (bool)
+        'score_source': how the score was arrived at, before the license
+            was checked - one of the SCORE_SOURCE_* values
 
     Raises QAError for reasonable errors
     """
+    with instrumentation.span('qa.resource_score', resource_id=resource.id,
+                              package_id=resource.package_id):
+        return _resource_score(resource, scoring_context)
+
+
+def _resource_score(resource, scoring_context):
     score = 0
     score_reason = ''
     format_ = None
+    score_source = None
+    scoring_context = scoring_context or ScoringContext()
 
     try:
         score_reasons = []  # a list of strings detailing how we scored it
-        archival = Archival.get_for_resource(resource_id=resource.id)
+        with instrumentation.span('qa.archival_lookup'):
+            archival = scoring_context.get_archival(resource.id)
         if not resource:
             raise QAError('Could not find resource "%s"' % resource.id)
 
-        score, format_ = score_if_link_broken(archival, resource, score_reasons)
+        score, format_ = score_if_link_broken(archival, resource, score_reasons,
+                                              scoring_context)
+        score_source = SCORE_SOURCE_BROKEN
         if score is None:
+            score_source = SCORE_SOURCE_FORMAT
             # we don't want to take the publisher's word for it, in case the link
             # is only to a landing page, so highest priority is the sniffed type
             score, format_ = score_by_sniffing_data(archival, resource,
@@ -171,11 +392,15 @@ def resource_score(resource):
                                     resource.id, resource.url)
                         score_reasons.append(_('Could not understand the file format, therefore score is 1.'))
                         score = 1
+                        score_source = SCORE_SOURCE_UNKNOWN
                         if format_ is None:
                             # use any previously stored format value for this resource
-                            format_ = get_qa_format(resource.id)
+                            format_ = get_qa_format(resource.id, scoring_context)
         score_reason = ' '.join(score_reasons)
         format_ = format_ or None
+        system_error = download_system_error_message()
+        transient_error = any(reason.startswith(system_error)
+                              for reason in score_reasons)
     except Exception as e:
         log.error('Unexpected error while calculating openness score %s: %s\nException: %s',
                   e.__class__.__name__, e, traceback.format_exc())
@@ -188,8 +413,7 @@ def resource_score(resource):
     # It is important we do this check after the link check, otherwise
     # the link checker won't get the chance to see if the resource
     # is broken.
-    package = resource.package
-    if score > 0 and not package.isopen():
+    if score > 0 and not scoring_context.package_is_open(resource.package):
         score_reason = _('License not open')
         score = 0
 
@@ -201,10 +425,14 @@ def resource_score(resource):
         'openness_score': score,
         'openness_score_reason': score_reason,
         'format': format_,
-        'archival_timestamp': archival_updated
+        'archival_timestamp': archival_updated,
+        'transient_error': transient_error,
+        'score_source': score_source,
     }
 
-    custom_result = custom_resource_score(resource, result)
+    with instrumentation.span('qa.iqa_hooks'):
+        custom_result = custom_resource_score(resource, result,
+                                              scoring_context.iqa_plugins)
 
     return custom_result or result
 
@@ -238,7 +466,8 @@ def broken_link_error_message(archival):
     return ' '.join(messages)
 
 
-def score_if_link_broken(archival, resource, score_reasons):
+def score_if_link_broken(archival, resource, score_reasons,
+                         scoring_context=None):
     '''
     Looks to see if the archiver said it was broken, and if so, writes to
     the score_reasons and returns a score.
@@ -252,12 +481,19 @@ def score_if_link_broken(archival, resource, score_reasons):
     if archival and archival.is_broken:
         # Score 0 since we are sure the link is currently broken
         score_reasons.append(broken_link_error_message(archival))
-        format_ = get_qa_format(resource.id)
+        format_ = get_qa_format(resource.id, scoring_context)
         log.info('Archiver says link is broken. Previous format: %r' % format_)
         return (0, format_)
     return (None, None)
 
 
+def download_system_error_message():
+    '''Returns the start of the reason given when the file could not be
+    downloaded due to a system error, e.g. a timeout or being rate
+    limited.'''
+    return _('A system error occurred during downloading this file')
+
+
 def score_by_sniffing_data(archival, resource, score_reasons):
     '''
     Looks inside a data file\'s contents to determine its format and score.
@@ -282,12 +518,13 @@ def score_by_sniffing_data(archival, resource, score_reasons):
             filepath = _download_url(archival.cache_url).name
             delete_file = True
         except Exception as e:
-            score_reasons.append(_('A system error occurred during downloading this file') + '. %s' % e)
+            score_reasons.append(download_system_error_message() + '. %s' % e)
             return (None, None)
 
     if filepath:
         try:
-            sniffed_format = sniff_format.sniff_file_format(filepath)
+            with instrumentation.span('qa.sniff_file_format'):
+                sniffed_format = sniff_format.sniff_file_format(filepath)
         finally:
             if delete_file:
                 try:
@@ -311,7 +548,7 @@ def score_by_sniffing_data(archival, resource, score_reasons):
             return (None, None)
         elif archival.is_broken is None and archival.status_id:
             # i.e. 'Download failure' or 'System error during archival'
-            score_reasons.append(_('A system error occurred during downloading this file') + '. '
+            score_reasons.append(download_system_error_message() + '. '
                                  + _('Reason') + ': %s. ' % archival.reason + _('Using other methods to determine file openness.'))
             return (None, None)
         else:
@@ -333,15 +570,20 @@ def _download_url(url):
     length = 0
     try:
         headers = {'Authorization': lib.get_job_apitoken()}
-        response = get_response(url, headers)
-
-        # download the file to a tempfile on disk
-        for chunk in response.iter_content(CHUNK_SIZE):
-            length += len(chunk)
-            if length > MAX_CONTENT_LENGTH:
-                log.warn("File size exceeds length limit %s, truncating", MAX_CONTENT_LENGTH)
-                break
-            tmp_file.write(chunk)
+        with instrumentation.span('qa.download', url=url):
+            response, slot = get_response(url, headers)
+            # the download slot for the host is held until the body is read
+            try:
+                # download the file to a tempfile on disk
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    length += len(chunk)
+                    if length > MAX_CONTENT_LENGTH:
+                        log.warn("File size exceeds length limit %s, truncating", MAX_CONTENT_LENGTH)
+                        break
+                    tmp_file.write(chunk)
+                    slot.renew()
+            finally:
+                slot.release()
 
     except requests.exceptions.HTTPError as error:
         # status code error
@@ -374,6 +616,12 @@ def _download_url(url):
 
 
 def get_response(url, headers):
+    '''Requests the url (just the headers, to start with), retrying if the
+    server asks. Returns (response, slot) where slot is the host's download
+    slot (see rate_limit), held for reading the body - release it after.
+    The slot is not held while waiting to retry.'''
+    limiter = rate_limit.get_limiter()
+
     def get_url():
         headers['Authorization'] = lib.get_job_apitoken()
         kwargs = {'headers': headers, 'timeout': DOWNLOAD_TIMEOUT,
@@ -381,20 +629,54 @@ def get_response(url, headers):
         if 'ckan.download_proxy' in config:
             proxy = config.get('ckan.download_proxy')
             kwargs['proxies'] = {'http': proxy, 'https': proxy}
-        return requests.get(url, **kwargs)
-    response = get_url()
-    if response.status_code == 202:
-        # Seen: https://data-cdfw.opendata.arcgis.com/datasets
+        limiter.throttle(url)
+        slot = limiter.acquire(url)
+        try:
+            return requests.get(url, **kwargs), slot
+        except BaseException:
+            slot.release()
+            raise
+
+    def discard(response, slot):
+        response.close()
+        slot.release()
+
+    response, slot = get_url()
+    if response.status_code in (401, 403):
+        # the cached site_user token may have been revoked or regenerated
+        rejected_token = headers['Authorization']
+        lib.invalidate_job_apitoken()
+        if lib.get_job_apitoken() != rejected_token:
+            discard(response, slot)
+            response, slot = get_url()
+    if response.status_code in (202, 429):
+        # 202 seen: https://data-cdfw.opendata.arcgis.com/datasets
         # In this case it means it's still processing, so do retries.
         # 202 can mean other things, but there's no harm in retries.
+        # 429 means the server wants us to back off, so honour its
+        # Retry-After rather than scoring the resource as a failure.
         wait = 1
-        while wait < 120 and response.status_code == 202:
+        while wait < 120 and response.status_code in (202, 429):
             # log.info('Retrying after {}s'.format(wait))
-            time.sleep(wait)
-            response = get_url()
+            discard(response, slot)
+            time.sleep(retry_after(response, wait))
+            response, slot = get_url()
             wait *= 3
-    response.raise_for_status()
-    return response
+    try:
+        response.raise_for_status()
+    except Exception:
+        discard(response, slot)
+        raise
+    return response, slot
+
+
+def retry_after(response, default):
+    '''Returns the seconds to wait before retrying, from the Retry-After
+    header if the server gave one (capped at 120s), else the default.'''
+    try:
+        return max(0, min(int(response.headers.get('Retry-After')), 120))
+    except (TypeError, ValueError):
+        return default
 
 
 def get_tmp_file(url):
@@ -493,36 +775,79 @@ def score_by_format_field(resource, score_reasons):
 
 def save_qa_result(resource, qa_result):
     """
-    Saves the results of the QA check to the qa table.
+    Saves the results of the QA check to the qa table, with a single upsert,
+    and updates the dataset's aggregated QA in the same transaction.
     """
     import ckan.model as model
-    from ckanext.qa.model import QA
+    from ckanext.qa.model import QA, QAPackage
 
-    now = datetime.datetime.utcnow()
+    row = qa_result_row(resource, qa_result, datetime.datetime.utcnow())
+    with instrumentation.span('qa.save_qa_result', resource_id=resource.id):
+        QA.upsert([row])
+        QAPackage.refresh([resource.package_id])
+        model.Session.commit()
 
-    qa = QA.get_for_resource(resource.id)
-    if not qa:
-        qa = QA.create(resource.id)
-        model.Session.add(qa)
-    else:
-        log.info(u'QA from before: %r', qa)
+    log.info('QA results updated ok')
+    return row  # for tests
+
+
+def qa_result_row(resource, qa_result, now):
+    '''Returns the qa table row for the result of a resource's QA check.
+    The id and created date are only used if the resource has no QA row
+    already.'''
+    from ckanext.qa.model import make_uuid
+    return {
+        'id': make_uuid(),
+        'package_id': resource.package_id,
+        'resource_id': resource.id,
+        'openness_score': qa_result['openness_score'],
+        'openness_score_reason': qa_result['openness_score_reason'],
+        'format': qa_result['format'],
+        'archival_timestamp': qa_result['archival_timestamp'],
+        'input_fingerprint': qa_result.get('input_fingerprint'),
+        'score_source': qa_result.get('score_source'),
+        'created': now,
+        'updated': now,
+        'checked': now,
+    }
 
-    for key in ('openness_score', 'openness_score_reason', 'format'):
-        setattr(qa, key, qa_result[key])
-    qa.archival_timestamp = qa_result['archival_timestamp']
-    qa.updated = now
 
-    model.Session.commit()
+def save_qa_results(package, qa_results, unchanged_resource_ids=()):
+    """
+    Saves the results of the QA checks of a package's resources to the qa
+    table, and the package's aggregated QA, in a single transaction.
 
-    log.info('QA results updated ok')
-    return qa  # for tests
+    They are written in one upsert, rather than a lookup, insert/update and
+    commit per resource. The aggregate is refreshed even if nothing was
+    scored, as resources may have been deleted since it was last saved.
+
+    :param package: the package the resources belong to
+    :param qa_results: list of (resource, qa_result) tuples
+    :param unchanged_resource_ids: resources that were checked but skipped
+        as unchanged - only their 'checked' date is updated
+    """
+    import ckan.model as model
+    from ckanext.qa.model import QA, QAPackage
+
+    now = datetime.datetime.utcnow()
+    rows = [qa_result_row(resource, qa_result, now)
+            for resource, qa_result in qa_results]
+    with instrumentation.span('qa.save_qa_results', package_id=package.id):
+        QA.mark_checked(list(unchanged_resource_ids), now)
+        QA.upsert(rows)
+        QAPackage.refresh([package.id])
+        model.Session.commit()
+
+    log.info('QA results updated ok for %i resources', len(rows))
+    return rows  # for tests
 
 
-def custom_resource_score(resource, resource_score):
+def custom_resource_score(resource, resource_score, observers=None):
     '''
     Broadcasts an IQA notification that an qa resource score was calculated
     '''
-    return qa_interfaces.IQA.custom_resource_score(resource, resource_score)
+    return qa_interfaces.IQA.custom_resource_score(resource, resource_score,
+                                                   observers)
 
 
 def compat_enqueue(name, fn, queue, args=[], kwargs={}):
@@ -534,10 +859,70 @@ def compat_enqueue(name, fn, queue, args=[], kwargs={}):
     enqueue_job(fn, args=args, kwargs=kwargs, queue=queue, title=nice_name)
 
 
-def create_qa_update_package_task(package, queue):
-    compat_enqueue('qa.update_package', update_package, queue, kwargs={'package_id': package.id})
+def _pending_package_key(package_id):
+    return '%s:%s:%s' % (PENDING_PACKAGE_KEY_PREFIX,
+                         config.get('ckan.site_id'), package_id)
+
+
+def claim_pending_package(package_id, queue):
+    '''Records that a QA job for the package is waiting in the queue.
+
+    Returns False if one is already waiting in that queue, in which case there
+    is no need to queue another. The record expires after
+    ckanext.qa.coalesce_ttl seconds (default 6 hours) in case the job is lost.
+    '''
+    redis_conn = lib.get_redis_connection()
+    key = _pending_package_key(package_id)
+    ttl = int(config.get('ckanext.qa.coalesce_ttl', 6 * 60 * 60))
+    if redis_conn.set(key, queue, nx=True, ex=ttl):
+        return True
+    pending_queue = redis_conn.get(key)
+    if pending_queue is not None and six.ensure_text(pending_queue) != queue:
+        # e.g. waiting in 'bulk' - don't hold up a 'priority' request
+        return True
+    redis_conn.incr(COALESCED_COUNT_KEY)
+    return False
+
+
+def release_pending_package(package_id):
+    '''Forgets that a QA job for the package is waiting, because one has
+    started.'''
+    lib.get_redis_connection().delete(_pending_package_key(package_id))
+
+
+def get_coalesced_count():
+    '''Returns the number of QA jobs that were not queued because the same
+    package was already waiting in the queue.'''
+    return int(lib.get_redis_connection().get(COALESCED_COUNT_KEY) or 0)
+
+
+def create_qa_update_package_task(package, queue, force=False,
+                                  coalesce=False, run_id=None):
+    '''Queues a QA job for the package.
+
+    If coalesce is True and a job for the package is already waiting in the
+    queue, no job is added, and False is returned.
+    '''
+    if coalesce and not claim_pending_package(package.id, queue):
+        log.debug('QA of package already waiting in job queue %s: %s',
+                  queue, package.name)
+        return False
+    compat_enqueue('qa.update_package', update_package, queue,
+                   kwargs={'package_id': package.id, 'force': force,
+                           'run_id': run_id})
     log.debug('QA of package put into job queue %s: %s',
               queue, package.name)
+    return True
+
+
+def create_qa_update_packages_task(package_ids, queue, force=False,
+                                   run_id=None):
+    compat_enqueue('qa.update_packages (%i datasets)' % len(package_ids),
+                   update_packages, queue,
+                   kwargs={'package_ids': package_ids, 'force': force,
+                           'run_id': run_id})
+    log.debug('QA of %i packages put into job queue %s',
+              len(package_ids), queue)
 
 
 def create_qa_update_task(resource, queue):
@@ -0,0 +1,515 @@
+# encoding: utf-8
+
+import csv
+import datetime
+import gzip
+import json
+
+import pytest
+
+from ckan import model
+
+from ckanext.qa.cli import commands
+from ckanext.qa import lib, model as qa_model, tasks
+from ckanext.archiver.model import Archival
+from ckanext.qa.tests.test_tasks import (  # noqa: F401
+    TODAY, _test_resource, reset_qa_db)
+
+
+def _test_qa(resource, **kwargs):
+    qa = qa_model.QA.create(resource.id)
+    for key, value in kwargs.items():
+        setattr(qa, key, value)
+    model.Session.add(qa)
+    model.Session.commit()
+    return qa
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestRescore(object):
+
+    def _rescored_qa(self, resource):
+        commands.rescore()
+        qa = qa_model.QA.get_for_resource(resource.id)
+        model.Session.refresh(qa)
+        return qa
+
+    def test_score_follows_format_scores(self, monkeypatch):
+        resource = _test_resource()
+        _test_qa(resource, format='CSV', openness_score=3,
+                 openness_score_reason='Format "CSV" receives score: 3.',
+                 score_source=tasks.SCORE_SOURCE_FORMAT)
+        scores = dict(lib.resource_format_scores(), CSV=2)
+        monkeypatch.setattr(lib, 'resource_format_scores', lambda: scores)
+
+        qa = self._rescored_qa(resource)
+
+        assert qa.openness_score == 2
+        assert 'receives openness score: 2' in qa.openness_score_reason
+        # the dataset's aggregate is refreshed
+        qa_package = qa_model.QAPackage.get(resource.package_id)
+        model.Session.refresh(qa_package)
+        assert qa_package.openness_score == 2
+
+    def test_reason_is_not_parsed(self, monkeypatch):
+        # e.g. a reason in another language
+        resource = _test_resource()
+        _test_qa(resource, format='CSV', openness_score=3,
+                 openness_score_reason='Format "CSV" otrzymuje ocenę 3.',
+                 score_source=tasks.SCORE_SOURCE_FORMAT)
+        scores = dict(lib.resource_format_scores(), CSV=2)
+        monkeypatch.setattr(lib, 'resource_format_scores', lambda: scores)
+
+        assert self._rescored_qa(resource).openness_score == 2
+
+    def test_licence_not_open(self):
+        resource = _test_resource(license_id=None)
+        _test_qa(resource, format='CSV', openness_score=3,
+                 openness_score_reason='Format "CSV" receives score: 3.',
+                 score_source=tasks.SCORE_SOURCE_FORMAT)
+
+        qa = self._rescored_qa(resource)
+
+        assert qa.openness_score == 0
+        assert qa.openness_score_reason == 'License not open'
+        assert qa.score_source == tasks.SCORE_SOURCE_FORMAT
+
+    def test_licence_made_open(self):
+        resource = _test_resource()
+        _test_qa(resource, format='CSV', openness_score=0,
+                 openness_score_reason='License not open',
+                 score_source=tasks.SCORE_SOURCE_FORMAT)
+
+        qa = self._rescored_qa(resource)
+
+        assert qa.openness_score == lib.resource_format_scores()['CSV']
+
+    def test_unknown_format_is_left_alone(self):
+        # the format is carried over from an earlier QA, but the score
+        # didn't come from it
+        resource = _test_resource()
+        reason = 'Could not understand the file format, therefore score is 1.'
+        _test_qa(resource, format='CSV', openness_score=1,
+                 openness_score_reason=reason,
+                 score_source=tasks.SCORE_SOURCE_UNKNOWN)
+
+        qa = self._rescored_qa(resource)
+
+        assert qa.openness_score == 1
+        assert qa.openness_score_reason == reason
+
+    def test_unknown_source_is_left_alone(self):
+        # scored before score_source was recorded
+        resource = _test_resource()
+        _test_qa(resource, format='CSV', openness_score=1,
+                 openness_score_reason='Format field is blank.')
+
+        assert self._rescored_qa(resource).openness_score == 1
+
+    def test_broken_link_scores_0(self):
+        resource = _test_resource()
+        archival = Archival.get_for_resource(resource.id)
+        archival.is_broken = True
+        archival.failure_count = 1
+        model.Session.commit()
+        _test_qa(resource, format='CSV', openness_score=3,
+                 openness_score_reason='Format "CSV" receives score: 3.',
+                 score_source=tasks.SCORE_SOURCE_FORMAT)
+
+        qa = self._rescored_qa(resource)
+
+        assert qa.openness_score == 0
+        assert qa.openness_score_reason.startswith(
+            'File could not be downloaded.')
+        assert qa.score_source == tasks.SCORE_SOURCE_BROKEN
+
+    def test_fixed_link_is_scored_on_its_format(self):
+        resource = _test_resource()
+        _test_qa(resource, format='CSV', openness_score=0,
+                 openness_score_reason='File could not be downloaded.',
+                 score_source=tasks.SCORE_SOURCE_BROKEN)
+
+        qa = self._rescored_qa(resource)
+
+        assert qa.openness_score == lib.resource_format_scores()['CSV']
+        assert qa.score_source == tasks.SCORE_SOURCE_FORMAT
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestResumableRun(object):
+
+    @pytest.fixture
+    def queued(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(
+            commands.tasks, 'create_qa_update_package_task',
+            lambda package, queue, force=False, run_id=None:
+                queued.append((package.id, run_id)))
+        return queued
+
+    def test_resume_queues_only_unfinished_packages(self, queued):
+        package_ids = [_test_resource().package_id for i in range(3)]
+
+        commands.update([], 'bulk')
+
+        run = qa_model.QARun.latest()
+        assert run.package_count == 3
+        assert sorted(queued) == sorted((id_, run.id) for id_ in package_ids)
+
+        tasks.mark_run_packages_completed(run.id, package_ids[:2])
+        assert run.progress()['completed'] == 2
+        del queued[:]
+
+        commands.update([], None, resume=run.id)
+
+        assert queued == [(package_ids[2], run.id)]
+
+    def test_resume_selects_datasets_missing_from_the_ledger(self, queued):
+        package_ids = [_test_resource().package_id for i in range(3)]
+        # 'qa update' died after recording only the first dataset
+        run = commands.create_run([], 'bulk', False, 1)
+        run.add_packages(package_ids[:1])
+        model.Session.commit()
+
+        commands.update([], None, resume=run.id)
+
+        assert sorted(queued) == sorted((id_, run.id) for id_ in package_ids)
+        assert qa_model.QARun.get(run.id).package_count == 3
+
+    def test_old_completed_runs_are_purged(self, queued):
+        package_ids = [_test_resource().package_id for i in range(2)]
+        commands.update([], 'bulk')
+        completed = qa_model.QARun.latest()
+        tasks.mark_run_packages_completed(completed.id, package_ids)
+        commands.update([], 'bulk')
+        unfinished = qa_model.QARun.latest()
+        for run in (completed, unfinished):
+            run.created = datetime.datetime.utcnow() - \
+                datetime.timedelta(days=commands.RUN_RETENTION_DAYS + 1)
+        model.Session.commit()
+        completed_id, unfinished_id = completed.id, unfinished.id
+
+        commands.update([], 'bulk')
+
+        run_ids = set(row.id for row in model.Session.query(qa_model.QARun.id))
+        assert completed_id not in run_ids
+        assert unfinished_id in run_ids
+        assert model.Session.query(qa_model.QARunPackage) \
+            .filter_by(run_id=completed_id).count() == 0
+
+        commands.purge_runs(days=1, include_unfinished=True)
+
+        run_ids = set(row.id for row in model.Session.query(qa_model.QARun.id))
+        assert unfinished_id not in run_ids
+        assert len(run_ids) == 1
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestUpdate(object):
+
+    @pytest.fixture
+    def queued_batches(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(
+            commands.tasks, 'create_qa_update_packages_task',
+            lambda package_ids, queue, force=False, run_id=None:
+                queued.append(package_ids))
+        return queued
+
+    def test_selection_is_streamed_in_chunks_of_whole_batches(
+            self, queued_batches, monkeypatch):
+        monkeypatch.setattr(commands, 'SELECTION_CHUNK_SIZE', 3)
+        package_ids = [_test_resource().package_id for i in range(5)]
+
+        commands.update([], 'bulk', batch_size=2)
+
+        # chunks of 2 datasets, as 3 is not a whole number of batches
+        assert [len(batch) for batch in queued_batches] == [2, 2, 1]
+        assert sorted(sum(queued_batches, [])) == sorted(package_ids)
+        run = qa_model.QARun.latest()
+        assert run.package_count == 5
+        assert run.progress()['total'] == 5
+
+    def test_dataset_selected_twice_is_queued_once(self, queued_batches):
+        resource = _test_resource()
+        package = model.Package.get(resource.package_id)
+
+        commands.update([package.owner_org, package.name], 'bulk',
+                        batch_size=10)
+
+        assert queued_batches == [[package.id]]
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestChangedSelection(object):
+
+    @pytest.fixture
+    def queued(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(
+            commands.tasks, 'create_qa_update_package_task',
+            lambda package, queue, force=False, run_id=None:
+                queued.append(package.id))
+        return queued
+
+    def test_stale(self, queued):
+        # archived on TODAY
+        fresh = _test_resource()
+        _test_qa(fresh, updated=TODAY + datetime.timedelta(days=1))
+        rearchived = _test_resource()
+        _test_qa(rearchived, updated=TODAY - datetime.timedelta(days=1))
+        unscored = _test_resource()
+
+        commands.update([], 'bulk', stale=True)
+
+        assert sorted(queued) == sorted([rearchived.package_id,
+                                         unscored.package_id])
+
+    def test_stale_is_not_reselected_when_skipped_as_unchanged(self, queued):
+        resource = _test_resource()
+        tasks.update_package_(resource.package_id)
+        # the description was edited since, which doesn't affect the score
+        an_hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        qa = qa_model.QA.get_for_resource(resource.id)
+        qa.updated = qa.checked = an_hour_ago - datetime.timedelta(hours=1)
+        model.Resource.get(resource.id).last_modified = an_hour_ago
+        model.Session.commit()
+        commands.update([], 'bulk', stale=True)
+        assert queued == [resource.package_id]
+        del queued[:]
+
+        counts = tasks.update_package_(resource.package_id)
+        commands.update([], 'bulk', stale=True)
+
+        assert counts == {'scored': 0, 'skipped': 1}
+        assert queued == []
+
+    def test_since(self, queued):
+        since = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        _test_resource()
+        rearchived = _test_resource()
+        archival = Archival.get_for_resource(rearchived.id)
+        archival.updated = since + datetime.timedelta(minutes=1)
+        model.Session.commit()
+
+        commands.update([], 'bulk', since=since)
+
+        assert queued == [rearchived.package_id]
+
+    def test_since_applies_to_resource_ids(self, monkeypatch):
+        queued = []
+        monkeypatch.setattr(
+            commands.tasks, 'create_qa_update_task',
+            lambda resource, queue: queued.append(resource.id))
+        unchanged = _test_resource()
+        rearchived = _test_resource()
+        since = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        archival = Archival.get_for_resource(rearchived.id)
+        archival.updated = since + datetime.timedelta(minutes=1)
+        model.Session.commit()
+
+        commands.update([unchanged.id, rearchived.id], None, since=since)
+
+        assert queued == [rearchived.id]
+
+    def test_nothing_changed_is_not_an_error(self, queued):
+        _test_resource()
+
+        since = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        commands.update([], 'bulk', since=since)
+
+        assert queued == []
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestRun(object):
+
+    def test_datasets_are_scored_by_worker_processes(self, capsys):
+        resources = [_test_resource() for i in range(3)]
+
+        commands.run([], processes=2)
+
+        for resource in resources:
+            assert qa_model.QA.get_for_resource(resource.id) is not None
+        out = capsys.readouterr().out
+        assert 'Datasets done: 3 (' in out
+        assert 'Resources scored: 3 (' in out
+        assert 'p95=' in out
+
+    def test_dataset_selected_twice_is_counted_once(self, capsys):
+        resource = _test_resource()
+        package = model.Package.get(resource.package_id)
+
+        commands.run([package.name, package.id], processes=1)
+
+        assert '1/1 done' in capsys.readouterr().err
+
+    def test_error_is_an_outcome(self):
+        outcome, object_id, duration, counts = \
+            commands._run_job(('package', 'missing', False))
+        assert outcome == 'Error: QAError'
+        assert counts == {}
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestStats(object):
+
+    def test_stats(self):
+        csv = _test_resource()
+        _test_qa(csv, format='CSV', openness_score=3, updated=TODAY)
+        broken = _test_resource()
+        archival = Archival.get_for_resource(broken.id)
+        archival.is_broken = True
+        model.Session.commit()
+        _test_qa(broken, format=None, openness_score=0,
+                 updated=TODAY - datetime.timedelta(days=400))
+
+        stats = commands.get_stats(
+            today=(TODAY + datetime.timedelta(days=2)).date())
+
+        assert stats['total'] == 2
+        assert stats['scores'] == {'0': 1, '3': 1}
+        assert stats['formats'] == {'CSV': 1, 'unknown': 1}
+        assert stats['staleness']['1-7 days'] == 1
+        assert stats['staleness']['over 1 year'] == 1
+        assert stats['broken'] == {'broken': 1, 'not broken': 1,
+                                   'archival error': 0, 'not archived': 0}
+        assert sum(org['resources'] for org in stats['organizations']) == 2
+        assert sum(org['broken'] for org in stats['organizations']) == 1
+
+    def test_sections_count_the_same_resources(self):
+        error = _test_resource()
+        archival = Archival.get_for_resource(error.id)
+        archival.is_broken = None  # e.g. a system error during archival
+        model.Session.commit()
+        _test_qa(error, format='CSV', openness_score=3, updated=TODAY)
+        not_archived = _test_resource(archived=False)
+        _test_qa(not_archived, format='CSV', openness_score=3, updated=TODAY)
+        deleted = _test_resource()
+        _test_qa(deleted, format='CSV', openness_score=3, updated=TODAY)
+        deleted.state = 'deleted'
+        model.Session.commit()
+
+        stats = commands.get_stats(today=TODAY.date())
+
+        assert stats['total'] == 2
+        assert sum(stats['scores'].values()) == 2
+        assert sum(stats['formats'].values()) == 2
+        assert sum(stats['staleness'].values()) == 2
+        assert stats['broken'] == {'broken': 0, 'not broken': 0,
+                                   'archival error': 1, 'not archived': 1}
+        assert sum(org['resources'] for org in stats['organizations']) == 2
+
+    def test_json(self, capsys):
+        _test_qa(_test_resource(), format='CSV', openness_score=3)
+
+        commands.stats(as_json=True)
+
+        assert json.loads(capsys.readouterr().out)['total'] == 1
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestPurgeOrphans(object):
+
+    def _delete_resource(self, resource):
+        resource.state = 'deleted'
+        model.Session.commit()
+
+    def test_purge(self):
+        active = _test_resource()
+        _test_qa(active)
+        deleted = [_test_resource() for i in range(3)]
+        for resource in deleted:
+            _test_qa(resource)
+            self._delete_resource(resource)
+
+        commands.purge_orphans(chunk_size=2)
+
+        assert qa_model.QA.get_for_resource(active.id) is not None
+        assert model.Session.query(qa_model.QA).count() == 1
+
+    def test_dry_run(self, capsys):
+        resource = _test_resource()
+        _test_qa(resource)
+        self._delete_resource(resource)
+
+        commands.purge_orphans(dry_run=True)
+
+        assert ': 1 (dry run' in capsys.readouterr().out
+        assert model.Session.query(qa_model.QA).count() == 1
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestExport(object):
+
+    def test_csv(self, tmp_path):
+        resource = _test_resource()
+        _test_qa(resource, format='CSV', openness_score=3, updated=TODAY)
+        output = str(tmp_path / 'qa.csv')
+
+        commands.export(output=output)
+
+        with open(output) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert rows[0]['resource_id'] == resource.id
+        assert rows[0]['package_name'] == resource.package.name
+        assert rows[0]['openness_score'] == '3'
+        assert rows[0]['updated'] == TODAY.isoformat()
+        assert rows[0]['archival_status'] == 'Archived successfully'
+
+    def test_gzipped_jsonl_with_filter(self, tmp_path):
+        _test_qa(_test_resource(), format='CSV', openness_score=3)
+        pdf = _test_resource()
+        _test_qa(pdf, format='PDF', openness_score=1)
+        output = str(tmp_path / 'qa.jsonl.gz')
+
+        commands.export(output=output, output_format='jsonl', compress=True,
+                        score=1)
+
+        with gzip.open(output, 'rt') as f:
+            rows = [json.loads(line) for line in f]
+        assert [row['resource_id'] for row in rows] == [pdf.id]
+        assert rows[0]['format'] == 'PDF'
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestImport(object):
+
+    def test_round_trip(self, tmp_path, capsys):
+        unchanged = _test_resource()
+        _test_qa(unchanged, format='CSV', openness_score=3)
+        changed = _test_resource()
+        _test_qa(changed, format='CSV', openness_score=3)
+        deleted = _test_resource()
+        _test_qa(deleted, format='PDF', openness_score=1)
+        output = str(tmp_path / 'qa.jsonl.gz')
+        commands.export(output=output, output_format='jsonl', compress=True)
+        # the bad scoring run that we want to undo
+        qa = qa_model.QA.get_for_resource(changed.id)
+        qa.openness_score = 0
+        model.Session.delete(qa_model.QA.get_for_resource(deleted.id))
+        model.Session.commit()
+        capsys.readouterr()
+
+        commands.import_qa(output)
+
+        out = capsys.readouterr().out
+        assert 'inserted: 1' in out
+        assert 'updated: 1' in out
+        assert 'skipped: 1' in out
+        for resource, score in ((unchanged, 3), (changed, 3), (deleted, 1)):
+            qa = qa_model.QA.get_for_resource(resource.id)
+            model.Session.refresh(qa)
+            assert qa.openness_score == score
+            assert qa.package_id == resource.package_id
+
+    def test_csv_row_for_unknown_resource_is_skipped(self, tmp_path):
+        filepath = str(tmp_path / 'qa.csv')
+        with open(filepath, 'w') as f:
+            f.write('resource_id,openness_score,updated\n'
+                    'not-a-resource,3,2020-01-01T00:00:00\n')
+
+        commands.import_qa(filepath)
+
+        assert model.Session.query(qa_model.QA).count() == 0
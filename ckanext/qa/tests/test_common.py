@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+import pytest
+
+from ckan import model
+try:
+    from ckan.tests import factories as ckan_factories
+except ImportError:
+    from ckan.new_tests import factories as ckan_factories
+
+from ckanext.qa.bin import common
+from ckanext.qa.bin.common import ResourceStream
+from ckanext.qa.tests.test_tasks import reset_qa_db  # noqa: F401
+
+
+def _test_dataset(name, owner_org, urls):
+    dataset = ckan_factories.Dataset(
+        name=name, owner_org=owner_org,
+        resources=[{'url': url} for url in urls])
+    return [res['id'] for res in dataset['resources']]
+
+
+def _set_state(obj_class, obj_id, state):
+    model.Session.query(obj_class).get(obj_id).state = state
+    model.Session.commit()
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestGetResources(object):
+
+    @pytest.fixture
+    def resource_ids(self):
+        org = ckan_factories.Organization(name='publisher-a')
+        other_org = ckan_factories.Organization(name='publisher-b')
+        res_ids = _test_dataset('dataset-a', org['id'],
+                                ['http://a/1', 'http://a/2', 'http://a/3'])
+        res_ids += _test_dataset('dataset-b', other_org['id'], ['http://b/1'])
+        deleted_dataset_res_ids = _test_dataset('dataset-c', org['id'],
+                                                ['http://c/1'])
+        _set_state(model.Package, model.Package.by_name('dataset-c').id,
+                   'deleted')
+        _set_state(model.Resource, res_ids[2], 'deleted')
+        return {'active': [res_ids[0], res_ids[1], res_ids[3]],
+                'deleted': [res_ids[2]],
+                'deleted dataset': deleted_dataset_res_ids}
+
+    def test_active_resources_of_active_datasets(self, resource_ids):
+        resources = common.get_resources(chunk_size=1)
+
+        assert isinstance(resources, ResourceStream)
+        assert len(resources) == 3
+        assert sorted(res.id for res in resources) == \
+            sorted(resource_ids['active'])
+
+    def test_columns(self, resource_ids):
+        resources = common.get_resources(
+            columns=(model.Resource.id, model.Resource.package_id),
+            chunk_size=1)
+
+        rows = list(resources)
+        assert len(rows) == len(resources) == 3
+        package_id = model.Package.by_name('dataset-b').id
+        assert (resource_ids['active'][2], package_id) in \
+            [tuple(row) for row in rows]
+
+    def test_state(self, resource_ids):
+        resources = common.get_resources(state='deleted')
+
+        assert [res.id for res in resources] == resource_ids['deleted']
+
+    def test_publisher(self, resource_ids):
+        resources = common.get_resources(publisher_ref='publisher-b')
+
+        assert [res.id for res in resources] == [resource_ids['active'][2]]
+
+    def test_dataset_name(self, resource_ids):
+        resources = common.get_resources(dataset_name='dataset-a')
+
+        assert sorted(res.id for res in resources) == \
+            sorted(resource_ids['active'][:2])
+
+    def test_resource_id(self, resource_ids):
+        res_id = resource_ids['active'][1]
+        resources = common.get_resources(resource_id=res_id)
+
+        assert len(resources) == 1
+        assert [res.id for res in resources] == [res_id]
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestResourceStream(object):
+
+    def test_len_of_an_ordered_query(self):
+        dataset = ckan_factories.Dataset(
+            resources=[{'url': 'http://%s/' % letter} for letter in 'cab'])
+        query = model.Session.query(model.Resource.url) \
+            .filter(model.Resource.package_id == dataset['id']) \
+            .order_by(model.Resource.url)
+        resources = ResourceStream(query, chunk_size=2)
+
+        # the COUNT drops the ORDER BY, and iterating keeps it
+        assert len(resources) == 3
+        assert [row.url for row in resources] == \
+            ['http://a/', 'http://b/', 'http://c/']
+
+    def test_len_is_counted_once(self):
+        dataset = ckan_factories.Dataset(resources=[{'url': 'http://a/'}])
+        query = model.Session.query(model.Resource) \
+            .filter(model.Resource.package_id == dataset['id'])
+        resources = ResourceStream(query)
+
+        assert len(resources) == 1
+        ckan_factories.Resource(package_id=dataset['id'])
+        assert len(resources) == 1
+        assert len(list(resources)) == 2
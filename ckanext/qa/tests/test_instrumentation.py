@@ -0,0 +1,117 @@
+# encoding: utf-8
+
+import json
+import logging
+import threading
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from ckanext.qa import instrumentation
+from ckanext.qa.instrumentation import QueryBudgetExceeded, QueryCounter
+
+
+@pytest.fixture
+def engine():
+    return create_engine('sqlite://')
+
+
+def run_queries(engine, number):
+    with engine.connect() as connection:
+        for i in range(number):
+            connection.execute(text('SELECT 1'))
+
+
+class TestQueryCounter(object):
+
+    def test_counts_statements(self, engine):
+        with QueryCounter(engine) as counter:
+            run_queries(engine, 3)
+        assert counter.count == 3
+        assert counter.statements == ['SELECT 1'] * 3
+        assert counter.db_time >= 0
+
+    def test_stops_counting_on_exit(self, engine):
+        with QueryCounter(engine) as counter:
+            run_queries(engine, 1)
+        run_queries(engine, 2)
+        assert counter.count == 1
+
+    def test_ignores_other_threads(self, engine):
+        with QueryCounter(engine) as counter:
+            thread = threading.Thread(target=run_queries, args=(engine, 2))
+            thread.start()
+            thread.join()
+            run_queries(engine, 1)
+        assert counter.count == 1
+
+    def test_within_budget(self, engine):
+        with QueryCounter(engine, budget=2, strict=True) as counter:
+            run_queries(engine, 2)
+        assert counter.count == 2
+
+    def test_over_budget_strict(self, engine):
+        with pytest.raises(QueryBudgetExceeded):
+            with QueryCounter(engine, budget=2, strict=True):
+                run_queries(engine, 3)
+
+    def test_over_budget_not_strict(self, engine):
+        with QueryCounter(engine, budget=2) as counter:
+            run_queries(engine, 3)
+        assert counter.count == 3
+
+
+@pytest.fixture
+def tracer_reset():
+    yield
+    instrumentation.set_tracer(None)
+
+
+@pytest.mark.usefixtures('tracer_reset')
+class TestSpan(object):
+
+    def test_disabled(self):
+        instrumentation.set_tracer(None)
+        with instrumentation.span('qa.test', resource_id='r') as span:
+            span.set_attribute('x', 1)
+        assert span is instrumentation.NULL_SPAN
+
+    def test_log(self):
+        records = []
+        logger = logging.getLogger('test_instrumentation.tracing')
+        logger.setLevel(logging.INFO)
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        instrumentation.set_tracer(instrumentation.LogTracer(logger))
+        try:
+            with instrumentation.span('qa.update_package', package_id='p'):
+                with instrumentation.span('qa.resource_score',
+                                          resource_id='r'):
+                    pass
+        finally:
+            logger.removeHandler(handler)
+        inner, outer = [json.loads(record.getMessage())
+                        for record in records]
+        assert inner['name'] == 'qa.resource_score'
+        assert inner['attributes'] == {'package_id': 'p', 'resource_id': 'r'}
+        assert inner['parent_id'] == outer['span_id']
+        assert inner['trace_id'] == outer['trace_id']
+        assert outer['parent_id'] is None
+        assert outer['duration_ms'] >= inner['duration_ms']
+
+    def test_file(self, tmp_path):
+        filepath = str(tmp_path / 'spans.jsonl')
+        instrumentation.set_tracer(instrumentation.FileTracer(filepath))
+        with pytest.raises(ValueError):
+            with instrumentation.span('qa.download', url='http://a.com/x'):
+                raise ValueError('broken')
+        with open(filepath) as f:
+            lines = [json.loads(line) for line in f]
+        assert len(lines) == 1
+        span = lines[0]['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+        assert span['name'] == 'qa.download'
+        assert span['attributes'] == [
+            {'key': 'url', 'value': {'stringValue': 'http://a.com/x'}}]
+        assert span['status'] == {'code': 2, 'message': 'ValueError: broken'}
+        assert int(span['endTimeUnixNano']) >= int(span['startTimeUnixNano'])
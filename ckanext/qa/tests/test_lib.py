@@ -0,0 +1,46 @@
+# encoding: utf-8
+
+import pytest
+
+from ckanext.qa import lib
+
+
+@pytest.fixture
+def site_user_calls(monkeypatch):
+    calls = []
+
+    def get_action(name):
+        assert name == 'get_site_user'
+
+        def get_site_user(context, data_dict):
+            calls.append(name)
+            return {'apikey': 'token-%s' % len(calls)}
+        return get_site_user
+
+    monkeypatch.setattr(lib, 'get_action', get_action)
+    monkeypatch.setattr(lib, '_JOB_APITOKEN_CACHE', None)
+    return calls
+
+
+class TestGetJobApitoken(object):
+
+    def test_site_user_token_is_cached(self, site_user_calls):
+        assert lib.get_job_apitoken() == 'token-1'
+        assert lib.get_job_apitoken() == 'token-1'
+        assert len(site_user_calls) == 1
+
+    def test_cache_expires(self, site_user_calls, monkeypatch):
+        lib.get_job_apitoken()
+        expiry = lib._JOB_APITOKEN_CACHE[1]
+        monkeypatch.setattr(lib.time, 'time', lambda: expiry + 1)
+        assert lib.get_job_apitoken() == 'token-2'
+
+    def test_invalidate(self, site_user_calls):
+        lib.get_job_apitoken()
+        lib.invalidate_job_apitoken()
+        assert lib.get_job_apitoken() == 'token-2'
+
+    def test_configured_token(self, site_user_calls, monkeypatch):
+        monkeypatch.setitem(lib.config, 'ckan.qa.api_token', 'configured-token')
+        assert lib.get_job_apitoken() == 'configured-token'
+        assert site_user_calls == []
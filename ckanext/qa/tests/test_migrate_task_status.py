@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+import datetime
+import json
+from optparse import Values
+
+import pytest
+
+from ckan import model
+
+from ckanext.archiver.model import Archival
+from ckanext.qa import model as qa_model
+from ckanext.qa.bin import migrate_task_status
+from ckanext.qa.bin.running_stats import BoundedStatsList
+from ckanext.qa.tests.test_commands import _test_qa
+from ckanext.qa.tests.test_tasks import (  # noqa: F401
+    TODAY, _test_resource, reset_qa_db)
+
+QA_DATE = TODAY + datetime.timedelta(hours=1)
+REVISION_DATE = TODAY - datetime.timedelta(days=1)
+REASON = 'Content of file appeared to be format "CSV" which receives ' \
+    'openness score: 3.'
+
+
+def _test_task_status(resource, score=3, reason=REASON, format='CSV'):
+    task_status = model.TaskStatus(
+        entity_id=resource.id, entity_type='resource', task_type='qa',
+        key='status', value=str(score), state='',
+        error=json.dumps({'reason': reason, 'format': format}),
+        last_updated=QA_DATE)
+    model.Session.add(task_status)
+    model.Session.commit()
+    return task_status
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestMigrateChunk(object):
+
+    def _migrate(self, monkeypatch, resources, revision_timestamps):
+        # ResourceRevision is not in newer CKANs, so supply its timestamps
+        monkeypatch.setattr(migrate_task_status, 'get_revision_timestamps',
+                            lambda resource_ids: revision_timestamps)
+        stats = BoundedStatsList()
+        migrate_task_status.migrate_chunk(
+            resources, Values({'write': True}), stats)
+        model.Session.commit()
+        return stats
+
+    def test_outcomes(self, monkeypatch):
+        added = _test_resource()
+        _test_task_status(added)
+        updated = _test_resource()
+        _test_task_status(updated, score=2)
+        _test_qa(updated, openness_score=3, openness_score_reason='Old',
+                 format='CSV', archival_timestamp=TODAY,
+                 resource_timestamp=REVISION_DATE, created=TODAY,
+                 updated=TODAY)
+        unchanged = _test_resource()
+        _test_task_status(unchanged)
+        _test_qa(unchanged, openness_score=3, openness_score_reason=REASON,
+                 format='CSV', archival_timestamp=TODAY,
+                 resource_timestamp=REVISION_DATE, created=TODAY,
+                 updated=TODAY)
+        no_revision = _test_resource()
+        _test_task_status(no_revision)
+        no_qa_data = _test_resource()
+        resources = [added, updated, unchanged, no_revision, no_qa_data]
+        revision_timestamps = dict(
+            (res.id, [REVISION_DATE]) for res in resources)
+        # only revised after the archival, so not the resource as QA saw it
+        revision_timestamps[no_revision.id] = [QA_DATE]
+
+        stats = self._migrate(monkeypatch, resources, revision_timestamps)
+
+        assert stats == {
+            'Added to QA table': 1,
+            'Updated in QA table': 1,
+            'Already exists correctly in QA table': 1,
+            'No resource revision before the QA': 1,
+            'No QA data': 1,
+        }
+        qas = qa_model.QA.get_for_resources([res.id for res in resources])
+        assert set(qas) == set([added.id, updated.id, unchanged.id])
+        for qa in qas.values():
+            model.Session.refresh(qa)
+        assert qas[added.id].package_id == added.package_id
+        assert qas[added.id].openness_score == 3
+        assert qas[added.id].format == 'CSV'
+        assert qas[added.id].archival_timestamp == TODAY
+        assert qas[added.id].resource_timestamp == REVISION_DATE
+        assert qas[updated.id].openness_score == 2
+        assert qas[updated.id].openness_score_reason == REASON
+
+    def test_archived_after_the_qa(self, monkeypatch):
+        resource = _test_resource()
+        _test_task_status(resource)
+        archival_date = QA_DATE + datetime.timedelta(days=1)
+        archival = Archival.get_for_resource(resource.id)
+        archival.updated = archival_date
+        model.Session.commit()
+
+        stats = self._migrate(monkeypatch, [resource],
+                              {resource.id: [REVISION_DATE]})
+
+        assert stats == {'Added to QA table': 1}
+        qa = qa_model.QA.get_for_resource(resource.id)
+        # the archival doesn't date the QA, so the QA's own date is used
+        assert qa.archival_timestamp == QA_DATE
+        assert qa.updated == QA_DATE
@@ -0,0 +1,72 @@
+# encoding: utf-8
+
+import datetime
+import logging
+import timeit
+
+from ckan import model
+from ckan.lib import dictization
+
+from ckanext.qa.model import QA
+
+log = logging.getLogger(__name__)
+
+NOW = datetime.datetime(2020, 1, 2, 3, 4, 5, 6)
+
+
+def _qa_objs(num_resources):
+    return [QA(id='qa-%i' % i, package_id='package', resource_id='res-%i' % i,
+               openness_score=3, openness_score_reason='Detected as CSV',
+               format='CSV', archival_timestamp=NOW, created=NOW, updated=NOW)
+            for i in range(num_resources)]
+
+
+class TestAsDict(object):
+
+    def test_same_as_table_dictize(self):
+        qa = _qa_objs(1)[0]
+        assert qa.as_dict() == \
+            dictization.table_dictize(qa, {'model': model})
+        assert qa.as_dict()['updated'] == '2020-01-02T03:04:05.000006'
+
+    def test_exclude(self):
+        qa_dict = _qa_objs(1)[0].as_dict(
+            exclude=('id', 'package_id', 'resource_id'))
+        assert 'resource_id' not in qa_dict
+        assert qa_dict['format'] == 'CSV'
+
+    def test_exclude_internal_columns(self):
+        qa = _qa_objs(1)[0]
+        qa.input_fingerprint = 'abc'
+        qa_dict = qa.as_dict(exclude=QA.INTERNAL_COLUMNS)
+        assert 'input_fingerprint' not in qa_dict
+        assert 'checked' not in qa_dict
+        assert qa_dict['openness_score'] == 3
+
+    def test_benchmark_500_resource_package(self):
+        # the serialization done by after_dataset_show for a package_show of
+        # a dataset with 500 resources
+        qa_objs = _qa_objs(500)
+
+        excluded = ('id', 'package_id', 'resource_id')
+
+        def with_table_dictize():
+            qa_dicts = []
+            for qa in qa_objs:
+                qa_dict = dictization.table_dictize(qa, {'model': model})
+                for key in excluded:
+                    del qa_dict[key]
+                qa_dicts.append(qa_dict)
+            return qa_dicts
+
+        def with_as_dict():
+            return [qa.as_dict(exclude=excluded) for qa in qa_objs]
+
+        assert with_as_dict() == with_table_dictize()
+        # the timings are only logged, as they vary too much on a busy
+        # machine to assert on
+        table_dictize_time = min(timeit.repeat(with_table_dictize, number=5,
+                                               repeat=3))
+        as_dict_time = min(timeit.repeat(with_as_dict, number=5, repeat=3))
+        log.info('500 resources x5: table_dictize %.4fs, as_dict %.4fs',
+                 table_dictize_time, as_dict_time)
@@ -0,0 +1,181 @@
+# encoding: utf-8
+
+import pytest
+
+from ckanext.qa import rate_limit
+from ckanext.qa.rate_limit import HostLimit, MemoryHostLimiter, \
+    RedisHostLimiter, parse_host_limits
+
+
+class FakeClock(object):
+    '''Time that only moves when something sleeps.'''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestParseHostLimits(object):
+
+    def test_full(self):
+        limits = parse_host_limits('a.com=2:3:5 B.org=0.5')
+        assert limits['a.com'] == HostLimit(2, 3, 5)
+        assert limits['b.org'] == HostLimit(0.5, 0, None)
+
+    def test_blank(self):
+        assert parse_host_limits(None) == {}
+        assert parse_host_limits('') == {}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            parse_host_limits('a.com=fast')
+
+
+class _LimiterTests(object):
+
+    def make_limiter(self, clock, default_limit=None, host_limits=None):
+        raise NotImplementedError
+
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(rate=2, burst=2))
+        for i in range(4):
+            limiter.throttle('http://a.com/data.csv')
+        # two in the burst, then one every 0.5s
+        assert clock.slept == [0.5, 0.5]
+
+    def test_hosts_are_independent(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(rate=1))
+        limiter.throttle('http://a.com/1')
+        limiter.throttle('http://b.com/1')
+        assert clock.slept == []
+        limiter.throttle('http://a.com/2')
+        assert clock.slept == [1]
+
+    def test_host_override(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(),
+                                    {'slow.org': HostLimit(rate=0.5)})
+        limiter.throttle('http://fast.org/1')
+        limiter.throttle('http://fast.org/2')
+        limiter.throttle('http://slow.org/1')
+        limiter.throttle('http://slow.org/2')
+        assert clock.slept == [2]
+
+    def test_unlimited(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock)
+        for i in range(10):
+            limiter.throttle('http://a.com/data.csv')
+            with limiter.slot('http://a.com/data.csv'):
+                pass
+        assert clock.slept == []
+
+
+class TestMemoryHostLimiter(_LimiterTests):
+
+    def make_limiter(self, clock, default_limit=None, host_limits=None):
+        return MemoryHostLimiter(default_limit, host_limits,
+                                 clock=clock.time, sleep=clock.sleep)
+
+    def test_slot_released(self):
+        limiter = self.make_limiter(FakeClock(), HostLimit(concurrency=1))
+        with limiter.slot('http://a.com/1'):
+            assert not limiter._semaphores['a.com'].acquire(False)
+        assert limiter._semaphores['a.com'].acquire(False)
+
+    def test_slot_wait_times_out(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(concurrency=1))
+        limiter.slot_timeout = 2
+        with limiter.slot('http://a.com/1'):
+            with limiter.slot('http://a.com/2') as slot:
+                assert slot.token is None
+        assert sum(clock.slept) == pytest.approx(2, abs=0.15)
+        # the slot that was held is released
+        assert limiter._semaphores['a.com'].acquire(False)
+
+
+class TestRedisHostLimiter(_LimiterTests):
+
+    def make_limiter(self, clock, default_limit=None, host_limits=None):
+        fakeredis = pytest.importorskip('fakeredis')
+        self.redis = fakeredis.FakeStrictRedis()
+        return RedisHostLimiter(self.redis, default_limit, host_limits,
+                                clock=clock.time, sleep=clock.sleep)
+
+    def test_shared_between_limiters(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(rate=1))
+        other_worker = RedisHostLimiter(self.redis, HostLimit(rate=1),
+                                        clock=clock.time, sleep=clock.sleep)
+        limiter.throttle('http://a.com/1')
+        other_worker.throttle('http://a.com/2')
+        assert clock.slept == [1]
+
+    def test_slot_waits_for_other_worker(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(concurrency=1))
+        key = limiter._key('slots', 'a.com')
+        # another worker is downloading
+        self.redis.zadd(key, {'other': clock.now + rate_limit.SLOT_TTL})
+
+        def release_on_sleep(seconds):
+            clock.sleep(seconds)
+            self.redis.zrem(key, 'other')
+        limiter._sleep = release_on_sleep
+
+        with limiter.slot('http://a.com/1'):
+            assert self.redis.zcard(key) == 1
+            assert not self.redis.zscore(key, 'other')
+        assert self.redis.zcard(key) == 0
+        assert clock.slept == [rate_limit.POLL_INTERVAL]
+
+    def test_slot_leaked_by_dead_worker_expires(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(concurrency=1))
+        key = limiter._key('slots', 'a.com')
+        # a worker died holding a slot, leased until 1s from now
+        self.redis.zadd(key, {'dead': clock.now + 1})
+
+        with limiter.slot('http://a.com/1'):
+            assert self.redis.zscore(key, 'dead') is None
+            assert self.redis.zcard(key) == 1
+        assert self.redis.zcard(key) == 0
+        # waiting doesn't extend the dead worker's lease
+        assert sum(clock.slept) == pytest.approx(1, abs=0.15)
+
+    def test_slot_wait_times_out(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(concurrency=1))
+        limiter.slot_timeout = 2
+        key = limiter._key('slots', 'a.com')
+        self.redis.zadd(key, {'other': clock.now + rate_limit.SLOT_TTL})
+
+        with limiter.slot('http://a.com/1'):
+            assert self.redis.zcard(key) == 1
+        assert self.redis.zcard(key) == 1
+        assert sum(clock.slept) == pytest.approx(2, abs=0.15)
+
+    def test_long_download_renews_its_lease(self):
+        clock = FakeClock()
+        limiter = self.make_limiter(clock, HostLimit(concurrency=1))
+        other_worker = RedisHostLimiter(self.redis, HostLimit(concurrency=1),
+                                        clock=clock.time, sleep=clock.sleep,
+                                        slot_timeout=0)
+
+        with limiter.slot('http://a.com/1') as slot:
+            clock.now += rate_limit.SLOT_TTL * 0.75
+            slot.renew()
+            # past the end of the original lease
+            clock.now += rate_limit.SLOT_TTL * 0.75
+            assert other_worker.acquire('http://a.com/2').token is None
+        assert other_worker.acquire('http://a.com/2').token is not None
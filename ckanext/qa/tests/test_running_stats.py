@@ -0,0 +1,48 @@
+# encoding: utf-8
+
+import pytest
+
+from ckanext.qa.bin import running_stats
+from ckanext.qa.bin.running_stats import BoundedStatsList
+
+
+class TestBoundedStatsList(object):
+
+    def test_counts_all_but_keeps_a_sample(self):
+        stats = BoundedStatsList()
+        for i in range(1000):
+            stats.add('Scored', 'res-%i' % i)
+
+        assert stats['Scored'] == 1000
+        assert stats._samples['Scored'] == ['res-%i' % i for i in range(10)]
+        value, count = stats.report_value('Scored')
+        assert count == 1000
+        assert value.startswith('1000 (')
+        assert "'res-9', ...]" in value
+
+    def test_percentiles(self):
+        stats = BoundedStatsList()
+        for i in range(1, 101):
+            stats.increment('Scored')
+            stats.record_latency('Scored', i / 100.0)
+
+        # to within a bucket (19%)
+        assert stats.percentile('Scored', 50) == pytest.approx(0.5, rel=0.2)
+        assert stats.percentile('Scored', 99) == pytest.approx(0.99, rel=0.2)
+        assert stats.percentile('Failed', 50) is None
+        assert 'p95=' in stats.report_value('Scored')[0]
+
+    def test_time(self, monkeypatch):
+        clock = iter([10.0, 12.0, 20.0, 20.5])
+        monkeypatch.setattr(running_stats.time, 'time', lambda: next(clock))
+        stats = BoundedStatsList()
+
+        with stats.time(value='res-1') as timer:
+            timer.category = 'Scored'
+        with pytest.raises(ValueError):
+            with stats.time(value='res-2'):
+                raise ValueError()
+
+        assert stats['Scored'] == 1
+        assert stats.percentile('Scored', 50) == pytest.approx(2, rel=0.2)
+        assert stats._samples['ValueError'] == ['res-2']
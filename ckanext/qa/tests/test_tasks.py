@@ -5,6 +5,8 @@ import logging
 from six.moves.urllib.parse import quote
 import datetime
 import pytest
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
 
 from ckan import model
 from ckan.plugins.toolkit import check_ckan_version, get_action, h
@@ -162,6 +164,7 @@ class TestResourceScore():
         assert 'Content of file appeared to be format "CSV"' in result['openness_score_reason'], result
         assert result['format'] == 'CSV', result
         assert result['archival_timestamp'] == TODAY_STR, result
+        assert result['score_source'] == ckanext.qa.tasks.SCORE_SOURCE_FORMAT
 
     def test_not_archived(self):
         result = resource_score(_test_resource(archived=False, cached=False, format=None))
@@ -173,6 +176,7 @@ class TestResourceScore():
         assert 'Could not determine a file extension in the URL.' in result['openness_score_reason'], result
         assert 'Format field is blank.' in result['openness_score_reason'], result
         assert 'Could not understand the file format, therefore score is 1.' in result['openness_score_reason'], result
+        assert result['score_source'] == ckanext.qa.tasks.SCORE_SOURCE_UNKNOWN
 
     def test_archiver_ran_but_not_cached(self):
         result = resource_score(_test_resource(cached=False, format=None))
@@ -317,8 +321,9 @@ class TestSaveQaResult(object):
         resource = _test_resource()
         qa_result = self.get_qa_result()
 
-        qa = ckanext.qa.tasks.save_qa_result(resource, qa_result)
+        ckanext.qa.tasks.save_qa_result(resource, qa_result)
 
+        qa = qa_model.QA.get_for_resource(resource.id)
         assert qa.openness_score == qa_result['openness_score']
         assert qa.openness_score_reason == qa_result['openness_score_reason']
         assert qa.format == qa_result['format']
@@ -326,6 +331,217 @@ class TestSaveQaResult(object):
         assert qa.updated, qa.updated
 
 
+def record_statements(func, *args, **kwargs):
+    '''Calls the function and returns the SQL statements it executed.'''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(model.meta.engine, 'before_cursor_execute',
+                 before_cursor_execute)
+    try:
+        func(*args, **kwargs)
+    finally:
+        event.remove(model.meta.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+    return statements
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestSaveQaResults(object):
+
+    def _test_package(self, num_resources):
+        dataset = ckan_factories.Dataset(
+            owner_org=_test_org().id,
+            resources=[{'url': 'http://example.com/%s.csv' % i}
+                       for i in range(num_resources)])
+        return model.Package.get(dataset['id'])
+
+    def test_insert_and_update(self):
+        package = self._test_package(3)
+        qa_result = TestSaveQaResult.get_qa_result()
+        qa_results = [(res, qa_result) for res in package.resources]
+
+        ckanext.qa.tasks.save_qa_results(package, qa_results)
+        updated_result = TestSaveQaResult.get_qa_result(openness_score=1)
+        ckanext.qa.tasks.save_qa_results(
+            package, [(res, updated_result) for res in package.resources])
+
+        for res in package.resources:
+            qa = qa_model.QA.get_for_resource(res.id)
+            assert qa.package_id == package.id
+            assert qa.openness_score == 1
+            assert qa.format == 'CSV'
+        assert model.Session.query(qa_model.QA).count() == 3
+
+    def test_fewer_queries_than_per_resource_saves(self):
+        qa_result = TestSaveQaResult.get_qa_result()
+
+        package = self._test_package(10)
+        resources = list(package.resources)
+
+        def save_individually():
+            for res in resources:
+                ckanext.qa.tasks.save_qa_result(res, qa_result)
+        individual_count = len(record_statements(save_individually))
+
+        package = self._test_package(10)
+        resources = list(package.resources)
+        batched_count = len(record_statements(
+            ckanext.qa.tasks.save_qa_results, package,
+            [(res, qa_result) for res in resources]))
+
+        log.info('Statements: %s individually, %s batched',
+                 individual_count, batched_count)
+        # 1 upsert and the package aggregate (2 lookups and 1 upsert), plus
+        # transaction handling
+        assert batched_count <= 6, batched_count
+        assert batched_count < individual_count / 5
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestQAPackage(object):
+
+    def test_saving_results_updates_the_aggregate(self):
+        resource = _test_resource()
+        ckanext.qa.tasks.save_qa_result(
+            resource, TestSaveQaResult.get_qa_result(openness_score=2))
+
+        qa_package = qa_model.QAPackage.get(resource.package_id)
+        assert qa_package.openness_score == 2
+        assert qa_package.resource_count == 1
+        assert qa_package.broken_count == 0
+        assert get_action('qa_package_openness_show')(
+            {}, {'id': resource.package_id})['openness_score'] == 2
+
+    def test_deleted_resource_is_removed_from_the_aggregate(self):
+        dataset = ckan_factories.Dataset(
+            owner_org=_test_org().id, license_id='uk-ogl',
+            resources=[{'url': 'http://example.com/data.csv'},
+                       {'url': 'http://example.com/data.txt'}])
+        ckanext.qa.tasks.update_package_(dataset['id'])
+        qa_package = qa_model.QAPackage.get(dataset['id'])
+        assert qa_package.resource_count == 2
+
+        model.Resource.get(dataset['resources'][1]['id']).state = 'deleted'
+        model.Session.commit()
+        counts = ckanext.qa.tasks.update_package_(dataset['id'])
+
+        assert counts == {'scored': 0, 'skipped': 1}
+        qa_package = qa_model.QAPackage.get(dataset['id'])
+        model.Session.refresh(qa_package)
+        assert qa_package.resource_count == 1
+
+    def test_rebuild(self):
+        resource = _test_resource()
+        ckanext.qa.tasks.save_qa_result(
+            resource, TestSaveQaResult.get_qa_result(openness_score=2))
+        archival = Archival.get_for_resource(resource.id)
+        archival.is_broken = True
+        qa = qa_model.QA.get_for_resource(resource.id)
+        qa.openness_score = 0
+        model.Session.commit()
+        orphan = qa_model.QAPackage(package_id='gone', openness_score=1)
+        model.Session.add(orphan)
+        model.Session.commit()
+
+        assert qa_model.QAPackage.rebuild() == 1
+
+        qa_package = qa_model.QAPackage.get(resource.package_id)
+        model.Session.refresh(qa_package)
+        assert qa_package.openness_score == 0
+        assert qa_package.broken_count == 1
+        assert model.Session.query(qa_model.QAPackage) \
+            .filter_by(package_id='gone').count() == 0
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestMigrateTables(object):
+
+    def test_duplicates_are_removed_and_resource_id_made_unique(self):
+        resource = _test_resource()
+        with model.meta.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_qa_resource_id'))
+            connection.execute(text(
+                'CREATE INDEX ix_qa_resource_id ON qa (resource_id)'))
+        for days, score in ((1, 1), (3, 3), (2, 2)):
+            qa = qa_model.QA.create(resource.id)
+            qa.openness_score = score
+            qa.updated = TODAY + datetime.timedelta(days=days)
+            model.Session.add(qa)
+            model.Session.commit()
+
+        qa_model.migrate_tables(model.meta.engine)
+
+        qas = model.Session.query(qa_model.QA).all()
+        assert [qa.openness_score for qa in qas] == [3]
+        # and saving again updates the row
+        ckanext.qa.tasks.save_qa_result(
+            resource, TestSaveQaResult.get_qa_result(openness_score=2))
+        qa = qa_model.QA.get_for_resource(resource.id)
+        assert qa.id == qas[0].id
+        assert qa.openness_score == 2
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestScoringContext(object):
+
+    def test_prefetched_rows_are_not_queried_again(self):
+        set_sniffed_format(None)
+        resource = _test_resource(format=None, cached=False)
+        archival = Archival.get_for_resource(resource.id)
+        archival.is_broken = True
+        archival.failure_count = 1
+        qa = qa_model.QA.create(resource.id)
+        qa.format = 'CSV'
+        model.Session.add(qa)
+        model.Session.commit()
+        package = resource.package
+        scoring_context = ckanext.qa.tasks.ScoringContext.for_package(package)
+
+        statements = record_statements(resource_score, resource,
+                                       scoring_context)
+
+        lookups = [statement for statement in statements
+                   if 'FROM archival' in statement or 'FROM qa' in statement]
+        assert lookups == []
+        assert scoring_context.get_archival(resource.id).id == archival.id
+        assert scoring_context.get_qa(resource.id).id == qa.id
+
+    def test_per_package_work_is_done_once(self, monkeypatch):
+        dataset = ckan_factories.Dataset(
+            owner_org=_test_org().id, license_id='uk-ogl',
+            resources=[{'url': 'http://example.com/%s.csv' % i}
+                       for i in range(20)])
+        package = model.Package.get(dataset['id'])
+        isopen_calls = []
+        original_isopen = model.Package.isopen
+
+        def isopen(package):
+            isopen_calls.append(package.id)
+            return original_isopen(package)
+        monkeypatch.setattr(model.Package, 'isopen', isopen)
+        plugin_lookups = []
+        original_plugin_implementations = ckanext.qa.tasks.PluginImplementations
+
+        def plugin_implementations(interface):
+            plugin_lookups.append(interface)
+            return original_plugin_implementations(interface)
+        monkeypatch.setattr(ckanext.qa.tasks, 'PluginImplementations',
+                            plugin_implementations)
+
+        ckanext.qa.tasks.update_package_(package.id, force=True)
+
+        assert isopen_calls == [package.id]
+        assert len(plugin_lookups) == 1
+
+    def test_not_prefetched(self):
+        resource = _test_resource()
+        scoring_context = ckanext.qa.tasks.ScoringContext()
+        assert scoring_context.get_archival(resource.id).resource_id == resource.id
+        assert scoring_context.get_qa(resource.id) is None
+
+
 @pytest.mark.usefixtures("with_plugins", "reset_qa_db")
 class TestUpdatePackage(object):
 
@@ -345,6 +561,261 @@ class TestUpdatePackage(object):
         assert qa.openness_score == 0
         assert qa.openness_score_reason == 'License not open'
 
+    @pytest.mark.ckan_config('ckanext.qa.query_budget', 20)
+    @pytest.mark.ckan_config('ckanext.qa.query_budget_strict', True)
+    def test_query_budget(self):
+        # the number of queries must not grow with the number of resources
+        dataset = ckan_factories.Dataset(
+            owner_org=_test_org().id, license_id='uk-ogl',
+            resources=[{'url': 'http://example.com/%s.csv' % i}
+                       for i in range(30)])
+        model.Session.remove()
+
+        counts = ckanext.qa.tasks.update_package_(dataset['id'])
+
+        assert counts['scored'] == 30
+
+    def test_unchanged_resources_are_skipped(self):
+        resource = _test_resource()
+        package_id = resource.package_id
+
+        counts = ckanext.qa.tasks.update_package_(package_id)
+        assert counts == {'scored': 1, 'skipped': 0}
+        qa = qa_model.QA.get_for_resource(resource.id)
+        assert qa.input_fingerprint
+        first_updated = qa.updated
+
+        counts = ckanext.qa.tasks.update_package_(package_id)
+        assert counts == {'scored': 0, 'skipped': 1}
+        assert qa_model.QA.get_for_resource(resource.id).updated == first_updated
+
+        counts = ckanext.qa.tasks.update_package_(package_id, force=True)
+        assert counts == {'scored': 1, 'skipped': 0}
+
+    def test_download_error_is_rescored_next_time(self, monkeypatch):
+        resource = _test_resource()
+        archival = Archival.get_for_resource(resource.id)
+        archival.cache_filepath = '/nonexistent/file.csv'
+        archival.cache_url = 'http://cache.example.com/file.csv'
+        model.Session.commit()
+
+        def timeout(url):
+            raise requests.exceptions.Timeout('Read timed out')
+        monkeypatch.setattr(ckanext.qa.tasks, '_download_url', timeout)
+
+        counts = ckanext.qa.tasks.update_package_(resource.package_id)
+        assert counts == {'scored': 1, 'skipped': 0}
+        qa = qa_model.QA.get_for_resource(resource.id)
+        assert 'system error occurred' in qa.openness_score_reason
+        assert qa.input_fingerprint is None
+
+        counts = ckanext.qa.tasks.update_package_(resource.package_id)
+        assert counts == {'scored': 1, 'skipped': 0}
+
+    def test_results_before_an_error_are_saved(self, monkeypatch):
+        dataset = ckan_factories.Dataset(
+            owner_org=_test_org().id,
+            resources=[{'url': 'http://example.com/%s.csv' % i}
+                       for i in range(2)])
+        failing_id = dataset['resources'][1]['id']
+        real_resource_score = ckanext.qa.tasks.resource_score
+
+        def resource_score(resource, scoring_context=None):
+            if resource.id == failing_id:
+                raise ValueError('Scoring failed')
+            return real_resource_score(resource, scoring_context)
+        monkeypatch.setattr(ckanext.qa.tasks, 'resource_score',
+                            resource_score)
+
+        with pytest.raises(ValueError):
+            ckanext.qa.tasks.update_package_(dataset['id'])
+
+        assert qa_model.QA.get_for_resource(dataset['resources'][0]['id'])
+        assert not qa_model.QA.get_for_resource(failing_id)
+
+    def test_database_error_is_raised_without_saving(self, monkeypatch):
+        resource = _test_resource()
+        saved = []
+
+        def resource_score(resource, scoring_context=None):
+            raise OperationalError('SELECT', {}, Exception('connection lost'))
+        monkeypatch.setattr(ckanext.qa.tasks, 'resource_score',
+                            resource_score)
+        monkeypatch.setattr(ckanext.qa.tasks, 'save_qa_results',
+                            lambda *args: saved.append(args))
+
+        with pytest.raises(OperationalError):
+            ckanext.qa.tasks.update_package_(resource.package_id)
+
+        assert saved == []
+
+    def test_changed_archival_is_rescored(self):
+        resource = _test_resource()
+        ckanext.qa.tasks.update_package_(resource.package_id)
+
+        archival = Archival.get_for_resource(resource.id)
+        archival.updated = TODAY + datetime.timedelta(days=1)
+        model.Session.commit()
+
+        counts = ckanext.qa.tasks.update_package_(resource.package_id)
+        assert counts == {'scored': 1, 'skipped': 0}
+
+
+@pytest.mark.usefixtures("with_plugins", "reset_qa_db")
+class TestUpdatePackages(object):
+
+    def test_error_does_not_stop_batch(self):
+        resource1 = _test_resource()
+        resource2 = _test_resource()
+
+        ckanext.qa.tasks.update_packages(package_ids=[
+            resource1.package_id, 'missing-package-id', resource2.package_id])
+
+        assert qa_model.QA.get_for_resource(resource1.id)
+        assert qa_model.QA.get_for_resource(resource2.id)
+
+
+class TestCoalescing(object):
+
+    class FakePackage(object):
+        id = 'package-id'
+        name = 'package-name'
+
+    @pytest.fixture
+    def enqueued(self, monkeypatch):
+        fakeredis = pytest.importorskip('fakeredis')
+        redis_conn = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr(ckanext.qa.lib, 'get_redis_connection',
+                            lambda: redis_conn)
+        jobs = []
+        monkeypatch.setattr(ckanext.qa.tasks, 'enqueue_job',
+                            lambda fn, **kwargs: jobs.append(kwargs))
+        return jobs
+
+    def test_duplicates_are_coalesced(self, enqueued):
+        package = self.FakePackage()
+        create_task = ckanext.qa.tasks.create_qa_update_package_task
+        assert create_task(package, 'bulk', coalesce=True)
+        assert not create_task(package, 'bulk', coalesce=True)
+        assert not create_task(package, 'bulk', coalesce=True)
+        assert len(enqueued) == 1
+        assert ckanext.qa.tasks.get_coalesced_count() == 2
+
+    def test_queued_again_once_job_starts(self, enqueued):
+        package = self.FakePackage()
+        create_task = ckanext.qa.tasks.create_qa_update_package_task
+        create_task(package, 'bulk', coalesce=True)
+        ckanext.qa.tasks.release_pending_package(package.id)
+        assert create_task(package, 'bulk', coalesce=True)
+        assert len(enqueued) == 2
+
+    def test_different_queue_not_coalesced(self, enqueued):
+        package = self.FakePackage()
+        create_task = ckanext.qa.tasks.create_qa_update_package_task
+        create_task(package, 'bulk', coalesce=True)
+        assert create_task(package, 'priority', coalesce=True)
+        assert len(enqueued) == 2
+
+    def test_not_coalescing(self, enqueued):
+        package = self.FakePackage()
+        create_task = ckanext.qa.tasks.create_qa_update_package_task
+        create_task(package, 'bulk')
+        create_task(package, 'bulk')
+        assert len(enqueued) == 2
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(self.status_code)
+
+
+class TestGetResponse(object):
+
+    @pytest.fixture
+    def server(self, monkeypatch):
+        '''Serves the responses in server.responses, in turn, recording the
+        Authorization header of each request and any sleeps.'''
+        class Server(object):
+            responses = []
+            tokens_sent = []
+            slept = []
+            tokens = ['token']
+        server = Server()
+
+        def get(url, headers=None, **kwargs):
+            server.tokens_sent.append(headers['Authorization'])
+            return server.responses.pop(0)
+        monkeypatch.setattr(ckanext.qa.tasks.requests, 'get', get)
+        monkeypatch.setattr(ckanext.qa.tasks.time, 'sleep',
+                            server.slept.append)
+        monkeypatch.setattr(ckanext.qa.lib, 'get_job_apitoken',
+                            lambda: server.tokens[0])
+        monkeypatch.setattr(ckanext.qa.lib, 'invalidate_job_apitoken',
+                            lambda: server.tokens.pop(0)
+                            if len(server.tokens) > 1 else None)
+        monkeypatch.setattr(ckanext.qa.rate_limit, 'get_limiter',
+                            ckanext.qa.rate_limit.HostLimiter)
+        return server
+
+    def test_429_is_retried_after_retry_after(self, server):
+        throttled = FakeResponse(429, {'Retry-After': '7'})
+        server.responses = [throttled, FakeResponse(200)]
+
+        response, slot = ckanext.qa.tasks.get_response(
+            'http://example.com/data.csv', {})
+
+        assert response.status_code == 200
+        assert server.slept == [7]
+        assert throttled.closed
+
+    def test_bad_retry_after_uses_the_default_delay(self, server):
+        server.responses = [FakeResponse(429, {'Retry-After': 'soon'}),
+                            FakeResponse(200)]
+
+        response, slot = ckanext.qa.tasks.get_response(
+            'http://example.com/data.csv', {})
+
+        assert response.status_code == 200
+        assert server.slept == [1]
+
+    def test_rejected_token_is_refetched_and_retried(self, server):
+        server.tokens = ['revoked', 'new']
+        rejected = FakeResponse(403)
+        server.responses = [rejected, FakeResponse(200)]
+
+        response, slot = ckanext.qa.tasks.get_response(
+            'http://example.com/data.csv', {})
+
+        assert response.status_code == 200
+        assert server.tokens_sent == ['revoked', 'new']
+        assert rejected.closed
+
+    def test_not_retried_if_the_token_is_the_same(self, server):
+        server.responses = [FakeResponse(401), FakeResponse(200)]
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            ckanext.qa.tasks.get_response('http://example.com/data.csv', {})
+
+        assert server.tokens_sent == ['token']
+
+    def test_retry_after(self):
+        retry_after = ckanext.qa.tasks.retry_after
+        assert retry_after(FakeResponse(429, {'Retry-After': '3'}), 1) == 3
+        assert retry_after(FakeResponse(429, {'Retry-After': '999'}), 1) == 120
+        assert retry_after(FakeResponse(429), 9) == 9
+        assert retry_after(FakeResponse(
+            429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 9) == 9
+
 
 @pytest.mark.usefixtures("with_plugins", "reset_qa_db")
 class TestUpdateResource(object):